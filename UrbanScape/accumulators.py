@@ -0,0 +1,177 @@
+'''
+Streaming per-cell statistics of replicate outputs, with confidence intervals
+'''
+
+import math
+import numpy as np
+
+# Replicate outputs are folded into running statistics one replicate at a time (Welford's update),
+# so memory stays that of a few arrays of the output's shape however many replicates are run.
+# Two accumulators over disjoint sets of replicates merge into the statistics of their union
+# (Chan et al.'s pairwise update), so partial results can be combined in whatever order they finish.
+
+#------------------------
+# Critical Values       |
+#------------------------
+
+#quantile p of the standard normal distribution (Acklam's rational approximation, relative error < 1.2e-9)
+def normal_quantile(p):
+	a = (-3.969683028665376e+01, 2.209460984245205e+02, -2.759285104469687e+02,
+	     1.383577518672690e+02, -3.066479806614716e+01, 2.506628277459239e+00)
+	b = (-5.447609879822406e+01, 1.615858368580409e+02, -1.556989798598866e+02,
+	     6.680131188771972e+01, -1.328068155288572e+01)
+	c = (-7.784894002430293e-03, -3.223964580411365e-01, -2.400758277161838e+00,
+	     -2.549732539343734e+00, 4.374664141464968e+00, 2.938163982698783e+00)
+	d = (7.784695709041462e-03, 3.224671290700398e-01, 2.445134137142996e+00, 3.754408661907416e+00)
+	if p < 0.02425:
+		q = math.sqrt(-2 * math.log(p))
+		return (((((c[0]*q+c[1])*q+c[2])*q+c[3])*q+c[4])*q+c[5]) / ((((d[0]*q+d[1])*q+d[2])*q+d[3])*q+1)
+	if p > 1 - 0.02425:
+		return -normal_quantile(1 - p)
+	q = p - 0.5
+	r = q * q
+	return (((((a[0]*r+a[1])*r+a[2])*r+a[3])*r+a[4])*r+a[5])*q / (((((b[0]*r+b[1])*r+b[2])*r+b[3])*r+b[4])*r+1)
+
+#P(|T| < t) for Student's t with integer df degrees of freedom (Abramowitz & Stegun 26.7.3-4)
+def t_central_probability(t, df):
+	theta = math.atan(abs(t) / math.sqrt(df))
+	cos2 = math.cos(theta)**2
+	term, series = 1.0, 1.0
+	if df % 2:
+		if df == 1:
+			return 2 * theta / math.pi
+		for k in range(1, (df - 1) // 2):
+			term *= cos2 * (2*k) / (2*k + 1.0)
+			series += term
+		return 2 / math.pi * (theta + math.sin(theta) * math.cos(theta) * series)
+	for k in range(1, df // 2):
+		term *= cos2 * (2*k - 1) / (2.0*k)
+		series += term
+	return math.sin(theta) * series
+
+def t_density(t, df):
+	return math.exp(math.lgamma((df + 1) / 2.0) - math.lgamma(df / 2.0) - (df + 1) / 2.0 * math.log1p(t*t / df)) / math.sqrt(df * math.pi)
+
+#quantile p of Student's t distribution with integer df degrees of freedom: exact for df 1 and 2, otherwise
+#the Cornish-Fisher expansion about the normal quantile (Abramowitz & Stegun 26.7.5) refined by Newton's method
+def t_quantile(p, df):
+	if df == 1:
+		return math.tan(math.pi * (p - 0.5))
+	if df == 2:
+		return (2*p - 1) / math.sqrt(2 * p * (1 - p))
+	z = normal_quantile(p)
+	g1 = (z**3 + z) / 4
+	g2 = (5*z**5 + 16*z**3 + 3*z) / 96
+	g3 = (3*z**7 + 19*z**5 + 17*z**3 - 15*z) / 384
+	g4 = (79*z**9 + 776*z**7 + 1482*z**5 - 1920*z**3 - 945*z) / 92160
+	t = z + g1/df + g2/df**2 + g3/df**3 + g4/df**4
+	for i in range(4):
+		cdf = 0.5 + math.copysign(t_central_probability(t, df), t) / 2
+		t -= (cdf - p) / t_density(t, df)
+	return t
+
+#------------------------
+# Accumulators          |
+#------------------------
+
+class RunningStatistics(object):
+	# Count, mean, variance, min and max of every cell of a stream of equally shaped arrays.
+	# The mean is kept as a running total divided by the count, so it is the same as the plain
+	# average of the arrays added; the variance comes from Welford's sum of squared deviations.
+	def __init__(self, shape = ()):
+		self.count = 0
+		self.total = np.zeros(shape)
+		self.running_mean = np.zeros(shape)
+		self.m2 = np.zeros(shape)
+		self.minimum = np.full(shape, np.inf)
+		self.maximum = np.full(shape, -np.inf)
+
+	def add(self, value):
+		value = np.asarray(value, dtype=float)
+		self.count += 1
+		self.total += value
+		delta = value - self.running_mean
+		self.running_mean += delta / self.count
+		self.m2 += delta * (value - self.running_mean)
+		np.minimum(self.minimum, value, out=self.minimum)
+		np.maximum(self.maximum, value, out=self.maximum)
+
+	#folds in the statistics of another accumulator over a disjoint set of arrays
+	def merge(self, other):
+		if other.count == 0:
+			return self
+		count = self.count + other.count
+		delta = other.running_mean - self.running_mean
+		self.m2 += other.m2 + delta**2 * (self.count * other.count / float(count))
+		self.running_mean += delta * (other.count / float(count))
+		self.total += other.total
+		self.count = count
+		np.minimum(self.minimum, other.minimum, out=self.minimum)
+		np.maximum(self.maximum, other.maximum, out=self.maximum)
+		return self
+
+	def mean(self):
+		return self.total / self.count
+
+	#sample variance (ddof = 1), nan with fewer than two arrays
+	def variance(self, ddof = 1):
+		if self.count <= ddof:
+			return np.full(self.m2.shape, np.nan)
+		return self.m2 / (self.count - ddof)
+
+	def std(self, ddof = 1):
+		return np.sqrt(self.variance(ddof))
+
+	#standard error of the mean
+	def sem(self):
+		return self.std() / math.sqrt(max(self.count, 1))
+
+	#half-width of the two-sided t confidence interval of the mean at the given level
+	def half_width(self, level = 0.95):
+		if self.count < 2:
+			return np.full(self.m2.shape, np.inf)
+		return t_quantile(0.5 + level / 2, self.count - 1) * self.sem()
+
+	#(low, high) confidence interval of the mean of every cell
+	def confidence_interval(self, level = 0.95):
+		mean, half_width = self.mean(), self.half_width(level)
+		return mean - half_width, mean + half_width
+
+#------------------------
+# Replicate Summaries   |
+#------------------------
+
+summary_names = ('externalities', 'mobility', 'income', 'ffagent_locations', 'gsagent_locations')
+
+class BatchStatistics(object):
+	# RunningStatistics of each output of urbanscape.replicate_summary: the (5, steps) externality
+	# quintiles and the terminal mobility, income and agent location grids
+	def __init__(self, grid_size, steps):
+		shapes = ((5,steps),) + ((grid_size,grid_size),) * 4
+		self.outputs = dict((name, RunningStatistics(shape)) for name, shape in zip(summary_names, shapes))
+
+	@property
+	def count(self):
+		return self.outputs['externalities'].count
+
+	def __getitem__(self, name):
+		return self.outputs[name]
+
+	def add(self, summary):
+		for name, value in zip(summary_names, summary):
+			self.outputs[name].add(value)
+
+	def merge(self, other):
+		for name in summary_names:
+			self.outputs[name].merge(other.outputs[name])
+		return self
+
+	#the averages in the order run_batch_experiments returns them
+	def means(self):
+		return tuple(self.outputs[name].mean() for name in summary_names)
+
+	def half_widths(self, level = 0.95):
+		return tuple(self.outputs[name].half_width(level) for name in summary_names)
+
+	def confidence_intervals(self, level = 0.95):
+		return tuple(self.outputs[name].confidence_interval(level) for name in summary_names)
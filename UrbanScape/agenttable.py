@@ -0,0 +1,87 @@
+'''
+Struct-of-arrays store for the food agents of an UrbanScape
+'''
+
+import numpy as np
+
+class AgentTable(object):
+	# Each live agent is one row across a set of typed columns.
+	# Rows are kept packed at the front of the column arrays; dead agents are removed
+	# by mask compaction and the arrays grow by doubling when they run out of room.
+	columns = (('id', np.int64),
+		('x', np.int64),
+		('y', np.int64),
+		('kind', np.int8),		#type code of the agent class
+		('wealth', np.float64),		# $ amount
+		('operating_costs', np.float64),	# $ per year
+		('birth', np.int64),		#time step the agent was added
+		('lane', np.int64))		#replicate the agent belongs to in an ensemble, 0 otherwise
+
+	def __init__(self, capacity = 64):
+		self.count = 0
+		self.next_id = 0
+		self.data = dict((name, np.zeros(capacity, dtype)) for name,dtype in self.columns)
+
+	def __len__(self):
+		return self.count
+
+	#live rows of a column, as a view that can be updated in place
+	def __getitem__(self, name):
+		return self.data[name][:self.count]
+
+	def grow(self, capacity):
+		for name, column in self.data.items():
+			resized = np.zeros(capacity, column.dtype)
+			resized[:self.count] = column[:self.count]
+			self.data[name] = resized
+
+	#adds a row and returns the id of the new agent
+	def append(self, kind, loc, wealth, operating_costs, birth, lane = 0):
+		x,y = loc
+		ids = self.extend(kind, [x], [y], wealth, operating_costs, birth, lane)
+		return int(ids[0])
+
+	#adds one row per entry of x and y (the other arguments may be scalars or arrays)
+	#and returns the ids of the new agents
+	def extend(self, kind, x, y, wealth, operating_costs, birth, lane = 0):
+		n = len(x)
+		if self.count + n > len(self.data['id']):
+			self.grow(max(2 * len(self.data['id']), self.count + n))
+		rows = slice(self.count, self.count + n)
+		ids = np.arange(self.next_id, self.next_id + n)
+		values = {'id': ids, 'x': x, 'y': y, 'kind': kind, 'wealth': wealth,
+			'operating_costs': operating_costs, 'birth': birth, 'lane': lane}
+		for name, value in values.items():
+			self.data[name][rows] = value
+		self.count += n
+		self.next_id += n
+		return ids
+
+	#keeps only the live rows where keep is True, preserving their order
+	def compact(self, keep):
+		keep = np.asarray(keep, dtype=bool)
+		n = int(keep.sum())
+		for name, column in self.data.items():
+			column[:n] = column[:self.count][keep]
+		self.count = n
+
+	#boolean mask of the live rows holding agents of the given type code
+	def of_kind(self, kind):
+		return self['kind'] == kind
+
+	#x and y coordinates of live agents, optionally only those of one type code
+	def locations(self, kind = None):
+		x, y = self['x'], self['y']
+		if kind is not None:
+			mask = self.of_kind(kind)
+			x, y = x[mask], y[mask]
+		return x, y
+
+	#an independent snapshot of the live rows
+	def copy(self):
+		table = AgentTable(max(self.count, 1))
+		for name in self.data:
+			table.data[name][:self.count] = self[name]
+		table.count = self.count
+		table.next_id = self.next_id
+		return table
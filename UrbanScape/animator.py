@@ -1,14 +1,128 @@
+import itertools
+import os
+import threading
+import Queue
+
 import urbanscape as us
+import trajectory
+import lod
+import numpy as np
 import matplotlib.pyplot as pyplot
 import matplotlib.animation as animation
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 
 ppcr = us.profit_probability_create_rule
 rcr = us.random_create_rule
 
+# The animator only draws: the simulation runs ahead in a SimulationFeeder thread that
+# pushes copies of the plotted grids into a bounded queue, and each animation frame
+# takes the next snapshot off the queue (or keeps the last one while the simulation catches up).
+# Snapshots are reduced to the display resolution by the producer (see lod.downsample_field),
+# so large grids are neither copied whole nor handed whole to imshow.
+
+frame_fields = ('income', 'ffcapture_number', 'externalities', 'agent_locations')
+
+
+#--------------------------
+# Frame Producers         |
+#--------------------------
+
+#copies of the grids the animator plots, reduced to at most resolution cells per side,
+#with the shape of the full grids and the time they were taken at
+def snapshot(urbanscape, resolution=lod.default_resolution):
+    frame = dict((name, np.array(lod.downsample_field(name, getattr(urbanscape, name), resolution)))
+                 for name in frame_fields)
+    frame['shape'] = urbanscape.income.shape
+    frame['time'] = urbanscape.time
+    return frame
+
+
+class SimulationFeeder(threading.Thread):
+    # Steps the urbanscape in the background and puts a snapshot after each step into a queue of
+    # at most queue_size frames, so the simulation never runs more than queue_size steps ahead of the display.
+    # Runs for steps steps, or until stopped if steps is None. Once stop() returns the thread has
+    # finished, so the urbanscape is safe to use from the caller again.
+    def __init__(self, urbanscape, steps=None, queue_size=8, resolution=lod.default_resolution):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.urbanscape = urbanscape
+        self.steps = steps
+        self.resolution = resolution
+        self.frames = Queue.Queue(maxsize=queue_size)
+        self.stopped = threading.Event()
+        self.error = None
+
+    def run(self):
+        taken = 0
+        try:
+            while not self.stopped.is_set() and (self.steps is None or taken < self.steps):
+                self.urbanscape.step()
+                taken += 1
+                self.put(snapshot(self.urbanscape, self.resolution))
+        except Exception as error:
+            self.error = error
+        finally:
+            self.put(None)
+
+    #puts an item into the queue, waiting for room only until the feeder is stopped
+    def put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.frames.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
 
-def animate_urbanscape(urbanscape):
+    #stops the simulation and waits for the step in progress to finish
+    def stop(self):
+        self.stopped.set()
+        while True:
+            try:
+                self.frames.get_nowait()
+            except Queue.Empty:
+                break
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
 
-    fig = pyplot.figure()
+    #the next frame, or None if none is ready yet (block=False) or the simulation has finished
+    def next_frame(self, block=True):
+        if self.error is not None:
+            raise self.error
+        try:
+            return self.frames.get(block)
+        except Queue.Empty:
+            return None
+
+    #consumes every frame of the run, in order
+    def __iter__(self):
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                if self.error is not None:
+                    raise self.error
+                return
+            yield frame
+
+
+#frames read from a trajectory stored with trajectory.TrajectoryRecorder
+def trajectory_frames(directory, start=0, stop=None, every=1, resolution=lod.default_resolution):
+    reader = trajectory.TrajectoryReader(directory)
+    for i in range(*slice(start, stop, every).indices(len(reader))):
+        frame = dict((name, lod.downsample_field(name, reader.read(name, i, i + 1)[0], resolution))
+                     for name in frame_fields)
+        frame['shape'] = tuple(reader.fields['income']['shape'])
+        frame['time'] = int(reader.times[i])
+        yield frame
+
+
+#--------------------------
+# Drawing                 |
+#--------------------------
+
+def setup_figure(frame, fig=None):
+    if fig is None:
+        fig = pyplot.figure()
     ax1 = fig.add_subplot(2, 2, 1)
     ax2 = fig.add_subplot(2, 2, 2)
     ax3 = fig.add_subplot(2, 2, 3)
@@ -22,30 +136,119 @@ def animate_urbanscape(urbanscape):
     ax1.tick_params(axis='x',labelsize=9)
     ax1.tick_params(axis='y',labelsize=9)
 
-    global u
-    u = urbanscape
+    extent = lod.grid_extent(frame['shape'])
+    im1 = ax1.imshow(frame['income'], interpolation = 'nearest',extent=extent)
+    im2 = ax2.imshow(frame['ffcapture_number'], cmap = 'YlOrRd',interpolation = 'nearest',extent=extent)
+    im3 = ax3.imshow(frame['externalities'], cmap = 'Purples',interpolation = 'nearest',extent=extent)
+    im4 = ax4.imshow(frame['agent_locations'], cmap = 'RdYlGn',interpolation = 'nearest',vmin=-1,vmax=1,extent=extent)
+
+    #colour limits of the first three images, widened as the run goes on
+    limits = (lod.ColorLimits(), lod.ColorLimits(), lod.ColorLimits())
+    for image, limit in zip((im1, im2, im3), limits):
+        limit.apply(image, image.get_array())
+    return fig, (im1, im2, im3, im4), limits
+
 
-    im1 = ax1.imshow(u.income, interpolation = 'nearest')
-    im2 = ax2.imshow(u.ffcapture_number, cmap = 'YlOrRd',interpolation = 'nearest')
-    im3 = ax3.imshow(u.externalities, cmap = 'Purples',interpolation = 'nearest')
-    im4 = ax4.imshow(u.agent_locations, cmap = 'RdYlGn',interpolation = 'nearest',vmin=-1,vmax=1)
+def update_images(images, limits, frame):
+    im1, im2, im3, im4 = images
+    limits[0].apply(im1, frame['income'])
+    limits[1].apply(im2, frame['ffcapture_number'])
+    limits[2].apply(im3, frame['externalities'])
+    im4.set_array(frame['agent_locations'])
+
+    return images
+
+
+#--------------------------
+# Live Animation          |
+#--------------------------
+
+#animates the urbanscape as it is simulated in a SimulationFeeder thread. the animation redraws every
+#interval ms, frames is the length of one cycle of the (repeating) matplotlib FuncAnimation, and the
+#simulation runs for steps steps, or until the figure is closed if steps is None. the feeder is stopped
+#when the figure is closed, not when pyplot.show() returns, so non-blocking backends (notebooks,
+#interactive mode) keep animating; call ani.feeder.stop() to stop it earlier
+def animate_urbanscape(urbanscape, frames=100, interval=1, queue_size=8, resolution=lod.default_resolution, steps=None):
+
+    feeder = SimulationFeeder(urbanscape, steps, queue_size, resolution)
+    fig, images, limits = setup_figure(snapshot(urbanscape, resolution))
+    fig.canvas.mpl_connect('close_event', lambda event: feeder.stop())
+    feeder.start()
 
     def updatefig(*args):
-        u.step()
-        im1.set_array(u.income)
-        im2.set_array(u.ffcapture_number)
-        im3.set_array(u.externalities)
-        im4.set_array(u.agent_locations)
-
-        im1.autoscale()
-        im2.autoscale()
-        im3.autoscale()
-        
-        return im1,im2,im3,im4
-        
-    ani = animation.FuncAnimation(fig,updatefig,frames=100,interval=1)
-
-    pyplot.show()
+        frame = feeder.next_frame(block=False)
+        if frame is not None:
+            update_images(images, limits, frame)
+        return images
+
+    ani = animation.FuncAnimation(fig,updatefig,frames=frames,interval=interval,blit=True)
+    ani.feeder = feeder
+
+    try:
+        pyplot.show()
+    except BaseException:
+        feeder.stop()
+        raise
+    return ani
+
+
+#--------------------------
+# Headless Rendering      |
+#--------------------------
+
+#draws frames on an Agg canvas, so no display is needed. output is either a directory, which gets
+#one frame-NNNNNN.png per frame, or an animation file written with the matplotlib writer named by
+#writer (by default 'pillow' for .gif and 'ffmpeg' for anything else; the writer has to be installed)
+def render_frames(frames, output, fps=10, dpi=100, writer=None):
+    frames = iter(frames)
+    first = next(frames, None)
+    if first is None:
+        return 0
+    fig, images, limits = setup_figure(first, Figure())
+    FigureCanvasAgg(fig)
+    frames = itertools.chain([first], frames)
+
+    extension = os.path.splitext(output)[1].lower()
+    if extension == '':
+        if not os.path.isdir(output):
+            os.makedirs(output)
+        count = 0
+        for frame in frames:
+            update_images(images, limits, frame)
+            fig.savefig(os.path.join(output, 'frame-%06d.png' % count), dpi=dpi)
+            count += 1
+        return count
+
+    if writer is None:
+        writer = 'pillow' if extension == '.gif' else 'ffmpeg'
+    if not animation.writers.is_available(writer):
+        raise ValueError('matplotlib animation writer %r is not available' % writer)
+    movie = animation.writers[writer](fps=fps)
+    count = 0
+    with movie.saving(fig, output, dpi):
+        for frame in frames:
+            update_images(images, limits, frame)
+            movie.grab_frame()
+            count += 1
+    return count
+
+
+#renders a trajectory recorded with trajectory.TrajectoryRecorder (which must include the frame_fields)
+def render_trajectory(directory, output, start=0, stop=None, every=1, fps=10, dpi=100, writer=None,
+                      resolution=lod.default_resolution):
+    frames = trajectory_frames(directory, start, stop, every, resolution)
+    return render_frames(frames, output, fps, dpi, writer)
+
+
+#runs the urbanscape for steps steps in a background thread and renders each step
+def render_urbanscape(urbanscape, steps, output, fps=10, dpi=100, writer=None, queue_size=8,
+                      resolution=lod.default_resolution):
+    feeder = SimulationFeeder(urbanscape, steps, queue_size, resolution)
+    feeder.start()
+    try:
+        return render_frames(feeder, output, fps, dpi, writer)
+    finally:
+        feeder.stop()
 
 #animator.animate_urbanscape(20, 100000, urbanscape.random_create_rule, "CBD", randomize=True)
 #animator.animate_urbanscape(20, 100000, urbanscape.profit_probability_create_rule, "CBD", randomize=True)
@@ -0,0 +1,182 @@
+'''
+Local catalog of experiment results: SQLite index plus array files, keyed by configuration, seed and model version
+'''
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+import numpy as np
+import randomstream
+import urbanscape as us
+from agenttable import AgentTable
+
+# A catalog directory holds catalog.sqlite, with one row per stored run, and arrays/<key>.npz with
+# the run's arrays. The key is a hash of the kind of run, its configuration, its seed and
+# us.model_version, so a run is only ever simulated once per model version. Each row also holds
+# scalar summaries of the run in indexed columns, so stored runs can be queried without loading grids.
+
+config_columns = (('grid_size', 'INTEGER'),
+		  ('rent_ceiling', 'REAL'),
+		  ('create_rule', 'TEXT'),
+		  ('distribution', 'TEXT'),
+		  ('randomize', 'INTEGER'),
+		  ('steps', 'INTEGER'),
+		  ('batches', 'INTEGER'))
+
+summary_columns = (('q1', 'REAL'),		#externality exposure of each income quintile at the last step
+		   ('q2', 'REAL'),
+		   ('q3', 'REAL'),
+		   ('q4', 'REAL'),
+		   ('q5', 'REAL'),
+		   ('mean_mobility', 'REAL'),
+		   ('mean_income', 'REAL'),
+		   ('ff_agents', 'REAL'),	#fast food agents alive at the end; for a batch, the average number of blocks
+						#holding at least one (agents stacked on a block by random_create_rule count once)
+		   ('gs_agents', 'REAL'))
+
+indexed = ('grid_size', 'rent_ceiling', 'create_rule', 'distribution', 'steps', 'q1', 'q5', 'mean_mobility', 'ff_agents', 'gs_agents')
+
+def canonical(value):
+	return json.dumps(value, sort_keys=True, separators=(',',':'))
+
+def rule_name(create_rule):
+	return create_rule.__name__ if callable(create_rule) else create_rule
+
+#the configuration of a run. model parameters are only part of it when they differ from the defaults,
+#so the keys of runs with the default constants stay the same
+def run_config(grid_size, rent_ceiling, create_rule, distribution, randomize, steps, batches, parameters):
+	config = {'grid_size': grid_size, 'rent_ceiling': rent_ceiling, 'create_rule': rule_name(create_rule),
+		  'distribution': distribution, 'randomize': randomize, 'steps': steps, 'batches': batches}
+	if parameters is not None and parameters.changes():
+		config['parameters'] = parameters.changes()
+	return config
+
+#------------------
+# Catalog         |
+#------------------
+
+class Catalog(object):
+	def __init__(self, directory):
+		self.directory = directory
+		if not os.path.isdir(os.path.join(directory, 'arrays')):
+			os.makedirs(os.path.join(directory, 'arrays'))
+		self.connection = sqlite3.connect(os.path.join(directory, 'catalog.sqlite'))
+		self.connection.row_factory = sqlite3.Row
+		columns = ', '.join('%s %s' % column for column in config_columns + summary_columns)
+		with self.connection:
+			self.connection.execute('CREATE TABLE IF NOT EXISTS runs (key TEXT PRIMARY KEY, kind TEXT, config TEXT, '
+						'seed TEXT, model_version TEXT, created REAL, seconds REAL, %s)' % columns)
+			for column in indexed:
+				self.connection.execute('CREATE INDEX IF NOT EXISTS runs_%s ON runs (%s)' % (column, column))
+
+	def close(self):
+		self.connection.close()
+
+	#the key of a run of the given kind ('experiment' or 'batch'), configuration and seed
+	def key(self, kind, config, seed):
+		identity = [kind, config, randomstream.seed_sequence(seed), us.model_version]
+		return hashlib.sha1(canonical(identity)).hexdigest()
+
+	def array_path(self, key):
+		return os.path.join(self.directory, 'arrays', key + '.npz')
+
+	def __contains__(self, key):
+		row = self.connection.execute('SELECT 1 FROM runs WHERE key = ?', (key,)).fetchone()
+		return row is not None and os.path.exists(self.array_path(key))
+
+	#the stored arrays of a run, as a dict, or None if the catalog doesn't hold it
+	def get(self, key):
+		if key not in self:
+			return None
+		with np.load(self.array_path(key)) as data:
+			return dict((name, data[name]) for name in data.files)
+
+	#stores the arrays (a dict) and scalar summary (a dict of summary_columns) of a run
+	def put(self, key, kind, config, seed, arrays, summary, seconds = None):
+		path = self.array_path(key)
+		with open(path + '.partial', 'wb') as f:
+			np.savez(f, **arrays)
+		os.rename(path + '.partial', path)
+
+		values = dict((name, config.get(name)) for name, _ in config_columns)
+		#a list of district centres or a dict of district_distribution arguments is stored as its JSON
+		if not isinstance(values['distribution'], (basestring, type(None))):
+			values['distribution'] = canonical(values['distribution'])
+		values.update(summary)
+		values.update({'key': key, 'kind': kind, 'config': canonical(config), 'seed': canonical(randomstream.seed_sequence(seed)),
+			       'model_version': us.model_version, 'created': time.time(), 'seconds': seconds})
+		names = sorted(values)
+		with self.connection:
+			self.connection.execute('INSERT OR REPLACE INTO runs (%s) VALUES (%s)' % (', '.join(names), ', '.join('?' * len(names))),
+						[values[name] for name in names])
+
+	#rows of the stored runs matching an SQL condition on the runs columns, as dicts, e.g.
+	#catalog.query('distribution = ? AND q1 > q5', ('CBD',)). only the index is read, never the arrays
+	def query(self, where = '1', parameters = (), order = 'created'):
+		cursor = self.connection.execute('SELECT * FROM runs WHERE %s ORDER BY %s' % (where, order), parameters)
+		return [dict(row) for row in cursor]
+
+	def __len__(self):
+		return self.connection.execute('SELECT COUNT(*) FROM runs').fetchone()[0]
+
+#------------------
+# Cached Runs     |
+#------------------
+
+def quintile_summary(externality_quintiles):
+	return dict(('q%d' % (q+1), float(externality_quintiles[q,-1]) if externality_quintiles.shape[-1] else None) for q in range(5))
+
+#run_experiment through the catalog: a stored run with the same configuration, seed and model version
+#is returned without simulating, anything else is run and stored. seed None runs with a fresh seed
+def cached_experiment(catalog, grid_size, rent_ceiling, create_rule, distribution, randomize = True, steps = 100, seed = None, parameters = None):
+	if seed is None:
+		seed = randomstream.fresh_seed()
+	config = run_config(grid_size, rent_ceiling, create_rule, distribution, randomize, steps, 1, parameters)
+	key = catalog.key('experiment', config, seed)
+	arrays = catalog.get(key)
+	if arrays is None:
+		start = time.time()
+		quintiles, mobility, income, agents = us.run_experiment(grid_size, rent_ceiling, getattr(us, config['create_rule']),
+									 distribution, randomize, steps, seed, parameters)
+		arrays = {'externality_quintiles': quintiles, 'mobility': mobility, 'income': income, 'agents.count': len(agents),
+			  'agents.next_id': agents.next_id}
+		for name in agents.data:
+			arrays['agents.' + name] = agents[name]
+		summary = quintile_summary(quintiles)
+		summary.update({'mean_mobility': float(mobility.mean()), 'mean_income': float(income.mean()),
+				'ff_agents': float(agents.of_kind(us.FastFoodAgent.code).sum()),
+				'gs_agents': float(agents.of_kind(us.GroceryStoreAgent.code).sum())})
+		catalog.put(key, 'experiment', config, seed, arrays, summary, time.time() - start)
+
+	agents = AgentTable(max(int(arrays['agents.count']), 1))
+	for name in agents.data:
+		agents.data[name][:int(arrays['agents.count'])] = arrays['agents.' + name]
+	agents.count = int(arrays['agents.count'])
+	agents.next_id = int(arrays['agents.next_id'])
+	return arrays['externality_quintiles'], arrays['mobility'], arrays['income'], agents
+
+batch_names = ('externalities', 'mobility', 'income', 'ffagent_locations', 'gsagent_locations')
+
+#run_batch_experiments through the catalog. processes doesn't change the result, so it isn't part
+#of the key; ensemble runs (and their memory_budget, which sets the ensemble chunks) are
+def cached_batch_experiments(catalog, batches, grid_size, rent_ceiling, create_rule, distribution, randomize = True, steps = 100, seed = None, processes = 1, ensemble = False, memory_budget = 2**28, parameters = None):
+	if seed is None:
+		seed = randomstream.fresh_seed()
+	config = run_config(grid_size, rent_ceiling, create_rule, distribution, randomize, steps, batches, parameters)
+	if ensemble:
+		config.update({'ensemble': True, 'memory_budget': memory_budget})
+	key = catalog.key('batch', config, seed)
+	arrays = catalog.get(key)
+	if arrays is None:
+		start = time.time()
+		averages = us.run_batch_experiments(batches, grid_size, rent_ceiling, getattr(us, config['create_rule']), distribution,
+						    randomize, steps, seed, processes, ensemble, memory_budget, parameters)
+		arrays = dict(zip(batch_names, averages))
+		summary = quintile_summary(arrays['externalities'])
+		summary.update({'mean_mobility': float(arrays['mobility'].mean()), 'mean_income': float(arrays['income'].mean()),
+				'ff_agents': float(arrays['ffagent_locations'].sum()), 'gs_agents': float(arrays['gsagent_locations'].sum())})
+		catalog.put(key, 'batch', config, seed, arrays, summary, time.time() - start)
+	return tuple(arrays[name] for name in batch_names)
@@ -0,0 +1,255 @@
+'''
+Checkpoint and resume for long UrbanScape runs
+'''
+
+import importlib
+import json
+import os
+import shutil
+import threading
+import Queue
+
+import numpy as np
+from agenttable import AgentTable
+from metrics import Observer
+from parameters import ModelParameters
+from randomstream import RandomStream
+
+# A checkpoint is a directory holding one .npy file per array of the simulation state
+# (grids, agent table columns, generator keys) and a state.json with everything else.
+# .npy files can be loaded memory-mapped, so restoring a large grid doesn't read it up front.
+
+FORMAT = 1
+
+#---------------------
+# Capture & Restore  |
+#---------------------
+
+def function_reference(function):
+	if getattr(function, '__name__', '<lambda>') == '<lambda>':
+		raise ValueError('cannot checkpoint a reference to ' + repr(function))
+	return [function.__module__, function.__name__]
+
+def resolve_reference(reference):
+	module, name = reference
+	return getattr(importlib.import_module(module), name)
+
+def plain(value):
+	if isinstance(value, np.generic):
+		return value.item()
+	if isinstance(value, tuple):
+		return {'tuple': [plain(v) for v in value]}
+	return value
+
+def unplain(value):
+	if isinstance(value, dict) and 'tuple' in value:
+		return tuple(unplain(v) for v in value['tuple'])
+	return value
+
+#copies the complete state of an urbanscape (or ensemble) into (arrays, meta): a dict of arrays
+#to be stored as .npy files and a JSON-serializable dict with everything else.
+#revenue tables and dirty regions are not stored; they are rebuilt from the rest of the state
+def capture_state(urbanscape):
+	arrays = {}
+	meta = {'format': FORMAT, 'class': function_reference(type(urbanscape)), 'attributes': {}}
+	for name, value in urbanscape.__dict__.items():
+		if name in ('revenue_tables', 'dirty_regions'):
+			continue
+		elif isinstance(value, np.ndarray):
+			arrays[name] = value.copy()
+		elif isinstance(value, AgentTable):
+			for column in value.data:
+				arrays[name + '.' + column] = value[column].copy()
+			meta['attributes'][name] = {'agents': {'count': value.count, 'next_id': value.next_id}}
+		elif isinstance(value, RandomStream):
+			state, buffer, position = value.get_state()
+			arrays[name + '.keys'] = state[1].copy()
+			arrays[name + '.buffer'] = buffer
+			meta['attributes'][name] = {'stream': [plain(v) for v in state[2:]], 'position': position,
+						    'block_size': value.block_size}
+		elif isinstance(value, np.random.RandomState):
+			state = value.get_state()
+			arrays[name + '.keys'] = state[1].copy()
+			meta['attributes'][name] = {'random_state': [plain(v) for v in state[2:]]}
+		elif isinstance(value, ModelParameters):
+			meta['attributes'][name] = {'parameters': value.as_dict()}
+		elif name == 'pending_captures':
+			arrays[name] = np.array(value, dtype=np.int64).reshape(-1,4)
+		elif callable(value):
+			meta['attributes'][name] = {'function': function_reference(value)}
+		else:
+			meta['attributes'][name] = {'value': plain(value)}
+	return arrays, meta
+
+def restore_random_state(keys, rest):
+	random_state = np.random.RandomState()
+	random_state.set_state(('MT19937', np.array(keys, dtype=np.uint32)) + tuple(rest))
+	return random_state
+
+#rebuilds an urbanscape from captured state. the restored run continues exactly as the original would have
+def restore_state(arrays, meta):
+	if meta.get('format') != FORMAT:
+		raise ValueError('unsupported checkpoint format ' + repr(meta.get('format')))
+	cls = resolve_reference(meta['class'])
+	urbanscape = cls.__new__(cls)
+	for name, value in arrays.items():
+		if '.' not in name and name != 'pending_captures':
+			setattr(urbanscape, name, value)
+
+	for name, attribute in meta['attributes'].items():
+		if 'agents' in attribute:
+			table = AgentTable(max(attribute['agents']['count'], 1))
+			for column in table.data:
+				table.data[column][:attribute['agents']['count']] = arrays[name + '.' + column]
+			table.count = attribute['agents']['count']
+			table.next_id = attribute['agents']['next_id']
+			value = table
+		elif 'stream' in attribute:
+			value = RandomStream(restore_random_state(arrays[name + '.keys'], attribute['stream']), attribute['block_size'])
+			value.buffer = np.array(arrays[name + '.buffer'], dtype=float)
+			value.position = attribute['position']
+		elif 'random_state' in attribute:
+			value = restore_random_state(arrays[name + '.keys'], attribute['random_state'])
+		elif 'parameters' in attribute:
+			value = ModelParameters(**attribute['parameters'])
+		elif 'function' in attribute:
+			value = resolve_reference(attribute['function'])
+		else:
+			value = unplain(attribute['value'])
+		setattr(urbanscape, name, value)
+
+	urbanscape.pending_captures = [tuple(int(v) for v in row) for row in arrays.get('pending_captures', [])]
+	urbanscape.dirty_regions = [np.s_[...]]
+	urbanscape.update_revenue_tables()
+	return urbanscape
+
+#-------------------
+# Checkpoint Files |
+#-------------------
+
+def write_state(arrays, meta, path):
+	partial = path + '.partial'
+	if os.path.exists(partial):
+		shutil.rmtree(partial)
+	os.makedirs(partial)
+	for name, array in arrays.items():
+		np.save(os.path.join(partial, name + '.npy'), array)
+	with open(os.path.join(partial, 'state.json'), 'w') as f:
+		json.dump(meta, f)
+	if os.path.exists(path):
+		shutil.rmtree(path)
+	os.rename(partial, path)	#a checkpoint directory only ever appears complete
+
+def save_checkpoint(urbanscape, path):
+	arrays, meta = capture_state(urbanscape)
+	write_state(arrays, meta, path)
+	return path
+
+#mmap = True maps the grids copy-on-write instead of reading them: the run can still
+#update them in place, and the checkpoint files are never modified
+def load_checkpoint(path, mmap = False):
+	with open(os.path.join(path, 'state.json')) as f:
+		meta = json.load(f)
+	arrays = {}
+	for filename in os.listdir(path):
+		if filename.endswith('.npy'):
+			arrays[filename[:-4]] = np.load(os.path.join(path, filename), mmap_mode = 'c' if mmap else None)
+	return restore_state(arrays, meta)
+
+#complete checkpoints in a directory, oldest first
+def checkpoint_paths(directory):
+	if not os.path.isdir(directory):
+		return []
+	names = sorted(name for name in os.listdir(directory) if name.startswith('step-') and not name.endswith('.partial'))
+	return [os.path.join(directory, name) for name in names]
+
+def latest_checkpoint(directory):
+	paths = checkpoint_paths(directory)
+	return paths[-1] if paths else None
+
+#the urbanscape from the most recent checkpoint in directory, or None if there is none
+def resume(directory, mmap = False):
+	path = latest_checkpoint(directory)
+	if path is None:
+		return None
+	return load_checkpoint(path, mmap)
+
+#-----------------
+# Checkpointer   |
+#-----------------
+
+class Checkpointer(object):
+	# Saves a checkpoint of the urbanscape into directory every interval steps and keeps
+	# only the newest keep of them. The state is copied on the calling thread, then written
+	# by a background thread so the step loop only waits when the writer falls behind.
+	def __init__(self, directory, interval = 100, keep = 3, background = True):
+		if keep < 1:
+			raise ValueError('a checkpointer has to keep at least one checkpoint, not %r' % keep)
+		self.directory = directory
+		self.interval = interval
+		self.keep = keep
+		self.background = background
+		self.error = None
+		self.queue = Queue.Queue(maxsize = 1)
+		self.writer = None
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+
+	def path(self, time):
+		return os.path.join(self.directory, 'step-%012d' % time)
+
+	#saves a checkpoint if the urbanscape's time is due; returns its path or None
+	def __call__(self, urbanscape):
+		if urbanscape.time % self.interval != 0:
+			return None
+		return self.save(urbanscape)
+
+	def save(self, urbanscape):
+		if self.error is not None:
+			raise self.error
+		arrays, meta = capture_state(urbanscape)
+		path = self.path(urbanscape.time)
+		if self.background:
+			if self.writer is None:
+				self.writer = threading.Thread(target = self.write_loop)
+				self.writer.daemon = True
+				self.writer.start()
+			self.queue.put((arrays, meta, path))
+		else:
+			self.write(arrays, meta, path)
+		return path
+
+	def write(self, arrays, meta, path):
+		write_state(arrays, meta, path)
+		for old in checkpoint_paths(self.directory)[:-self.keep]:
+			shutil.rmtree(old)
+
+	def write_loop(self):
+		while True:
+			job = self.queue.get()
+			try:
+				if job is None:
+					return
+				self.write(*job)
+			except Exception as error:
+				self.error = error
+			finally:
+				self.queue.task_done()
+
+	#an observer that checkpoints through metrics.observe, e.g. observers = [checkpointer.observer()]
+	def observer(self):
+		return Observer('checkpoint', self.save, self.interval)
+
+	#blocks until every queued checkpoint has been written
+	def wait(self):
+		self.queue.join()
+		if self.error is not None:
+			raise self.error
+
+	def close(self):
+		if self.writer is not None:
+			self.queue.put(None)
+			self.writer.join()
+			self.writer = None
+		if self.error is not None:
+			raise self.error
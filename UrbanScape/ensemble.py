@@ -0,0 +1,198 @@
+'''
+Lockstep ensemble of UrbanScape replicates advanced together over stacked (B, N, N) state arrays
+'''
+
+import numpy as np
+import kernels
+import randomstream
+import urbanscape as us
+from parameters import ModelParameters, stack
+
+#-------------------------
+# Ensemble of Replicates |
+#-------------------------
+
+class UrbanScapeEnsemble(us.UrbanScape):
+	# B replicates ("lanes") of the same urbanscape configuration. Every grid attribute of
+	# UrbanScape gets a leading lane axis, the agents of all lanes share one agent table
+	# (with a lane column) and the occupancy is indexed (type code, lane, x, y), so each
+	# update phase advances all of the lanes with the same whole-array calls.
+	# parameters is one ModelParameters for every lane, a ModelParameters with per-lane values,
+	# or a list of one ModelParameters per lane, so that each lane runs its own parameter set.
+	def __init__(self, lanes, size, rent, create_rule=None, gradient = None, randomize = False, seed = None, parameters = None):
+		if seed is None:
+			seed = randomstream.fresh_seed()
+		if parameters is None:
+			parameters = ModelParameters()
+		elif isinstance(parameters, (list, tuple)):
+			parameters = stack(parameters)
+		if parameters.lanes() not in (None, lanes):
+			raise ValueError('parameters given for %d lanes, not %d' % (parameters.lanes(), lanes))
+		self.seed = seed
+		self.lanes = lanes
+		self.size = size
+		self.parameters = parameters
+		self.create_rule = ensemble_create_rule(create_rule)
+		self.vectorized = True
+		self.time = 0
+
+		#lane k starts from the initial state of a single urbanscape seeded with (seed, k)
+		starts = [us.UrbanScape(size, rent, None, gradient, randomize, seed = lane_seed, parameters = parameters.lane(k))
+			  for k, lane_seed in enumerate(randomstream.replicate_seeds(seed, lanes))]
+		self.rent_ceiling = rent
+		self.rent_floor = starts[0].rent_floor
+		for name in ('rent', 'income', 'food_away', 'fast_food', 'grocery',
+			     'food_away_base', 'fast_food_base', 'grocery_base'):
+			setattr(self, name, np.array([getattr(u, name) for u in starts]))
+		del starts
+
+		blocks = np.ones((lanes,size,size))
+		self.externalities = np.zeros_like(blocks)
+		for agent_type in us.agent_types:
+			setattr(self, agent_type.capture_field, np.zeros_like(blocks))
+		self.mobility = np.ones_like(blocks)
+		self.net_capture = np.zeros_like(blocks)
+		self.heal_buffer = np.zeros_like(blocks)
+		self.heal_mask = np.zeros(blocks.shape, dtype=bool)
+		self.dirty_regions = [np.s_[...]]
+
+		self.agents = us.AgentTable()
+		self.occupancy = np.zeros((len(us.agent_types),lanes,size,size), dtype=int)
+		self.occupancy_version = 0
+		self.pending_captures = []
+
+		self.random_state = randomstream.stream_state(seed, randomstream.ENSEMBLE_GRID_STREAM)
+		self.decisions = randomstream.stream_state(seed, randomstream.ENSEMBLE_DECISION_STREAM)
+		self.update_revenue_tables()
+
+	#adds one agent of agent_type to each of the given lanes, at blocks (x,y)
+	def add_agents(self, agent_type, lanes, x, y):
+		lanes, x, y = np.asarray(lanes), np.asarray(x), np.asarray(y)
+		operations = self.lane_values(self.parameters.agent(agent_type, 'operations', ndim=1), lanes)
+		initial_wealth = self.lane_values(self.parameters.agent(agent_type, 'initial_wealth', ndim=1), lanes)
+		operating_costs = self.rent[lanes,x,y] + operations
+		self.agents.extend(agent_type.code, x, y, initial_wealth, operating_costs, self.time, lanes)
+		np.add.at(self.occupancy, (agent_type.code, lanes, x, y), 1)
+		self.occupancy_version += 1
+
+	#a parameter value for each of the given lanes
+	def lane_values(self, value, lanes):
+		return value[lanes] if isinstance(value, np.ndarray) else value
+
+	def add_agent(self, agent, lane = 0):
+		x,y = agent.loc
+		self.add_agents(type(agent), [lane], [x], [y])
+
+	def occupancy_index(self, rows):
+		agents = self.agents
+		return agents['kind'][rows], agents['lane'][rows], agents['x'][rows], agents['y'][rows]
+
+	def agent_lanes(self, rows):
+		return self.agents['lane'][rows]
+
+	#the lanes rarely share agent births and deaths, so the capture numbers are refiltered every step
+	def update_capture_number(self):
+		self.filter_capture_number()
+		self.pending_captures = []
+
+	def update_externalities(self):
+		self.inplace_externalities()
+
+#------------------------------
+# Ensemble Create Rules       |
+#------------------------------
+
+#creates a FastFoodAgent or a GroceryStoreAgent at a random block of every lane, every 5th step
+def ensemble_random_create_rule(ensemble):
+	if ensemble.time % 5 == 0:
+		lanes = np.arange(ensemble.lanes)
+		x = ensemble.decisions.randint(0, ensemble.size, ensemble.lanes)
+		y = ensemble.decisions.randint(0, ensemble.size, ensemble.lanes)
+		fastfood = ensemble.decisions.random_sample(ensemble.lanes) < 0.5
+		ensemble.add_agents(us.FastFoodAgent, lanes[fastfood], x[fastfood], y[fastfood])
+		ensemble.add_agents(us.GroceryStoreAgent, lanes[~fastfood], x[~fastfood], y[~fastfood])
+
+#profit_probability_create_rule for every lane at once: the profit margin surfaces of all lanes,
+#the create probabilities relative to each lane's best available block, and one draw per lane
+#to decide whether and where to create an agent of each type
+def ensemble_profit_probability_create_rule(ensemble):
+	prob_max = ensemble.parameters.get('prob_max', ndim=2)
+	n = ensemble.lanes
+	for agent_type in us.agent_types:
+		available = (ensemble.type_occupancy(agent_type.code) == 0).reshape(n,-1)
+		margins = us.profit_margin_surface(ensemble, agent_type.label).reshape(n,-1)
+		maximum = np.where(available, margins, -np.inf).max(axis=1)
+
+		rand = ensemble.decisions.random_sample(n)
+		with np.errstate(invalid='ignore', divide='ignore'):
+			prob_multiplier = margins / maximum[:,None]
+		prob_multiplier[~available | (prob_multiplier < 0)] = 0
+		probability = prob_max * prob_multiplier
+		create_locations = available & (rand[:,None] < probability)
+
+		#picks a random location from the locations of each lane that made it through the decision
+		counts = create_locations.sum(axis=1)
+		lanes = np.flatnonzero(counts)
+		choice = (ensemble.decisions.random_sample(len(lanes)) * counts[lanes]).astype(int)
+		blocks = np.argmax(np.cumsum(create_locations[lanes], axis=1) > choice[:,None], axis=1)
+		ensemble.add_agents(agent_type, lanes, blocks // ensemble.size, blocks % ensemble.size)
+
+ensemble_create_rules = {us.no_create_rule: us.no_create_rule,
+			 us.random_create_rule: ensemble_random_create_rule,
+			 us.profit_probability_create_rule: ensemble_profit_probability_create_rule}
+
+#the ensemble version of a single-urbanscape create rule
+def ensemble_create_rule(create_rule):
+	if create_rule is None or create_rule in ensemble_create_rules.values():
+		return create_rule
+	try:
+		return ensemble_create_rules[create_rule]
+	except KeyError:
+		raise ValueError('no ensemble version of create rule ' + repr(create_rule))
+
+#------------------------------
+# Ensemble Experiments        |
+#------------------------------
+
+#approximate bytes of state one lane needs: about two dozen N x N grids of working state
+#plus occupancy, capture numbers and revenue tables per agent type, and the quintile history
+def lane_bytes(grid_size, steps):
+	grids = 24 + 3 * len(us.agent_types)
+	return (grids * (grid_size + 1)**2 + 5 * steps) * 8
+
+#runs batches replicates as ensembles of as many lanes as fit in memory_budget bytes and yields,
+#replicate by replicate, the same summary as urbanscape.replicate_summary. chunk c of the lanes
+#is seeded with (seed, c) and its lane k starts from the initial state of seed (seed, c, k).
+#parameters may give per-lane values for all batches replicates (see parameters.stack)
+def ensemble_summaries(batches, grid_size, rent_ceiling, create_rule, distribution, randomize = True, steps = 100, seed = None, memory_budget = 2**28, parameters = None):
+	if seed is None:
+		seed = randomstream.fresh_seed()
+	chunk = int(max(1, min(batches, memory_budget // lane_bytes(grid_size, steps))))
+	if parameters is None:
+		parameters = ModelParameters()
+	elif isinstance(parameters, (list, tuple)):
+		parameters = stack(parameters)
+
+	for c, start in enumerate(range(0, batches, chunk)):
+		lanes = min(chunk, batches - start)
+		chunk_seed = tuple(randomstream.seed_sequence(seed)) + (c,)
+		lane_parameters = parameters.select(slice(start, start + lanes)) if parameters.lanes() else parameters
+		ensemble = UrbanScapeEnsemble(lanes, grid_size, rent_ceiling, create_rule, distribution, randomize, chunk_seed, lane_parameters)
+
+		externality_quintiles = np.empty((lanes,5,steps))
+		for i in range(steps):
+			ensemble.step()
+			externality_quintiles[:,:,i] = kernels.quintile_means(ensemble.income, ensemble.externalities)
+
+		ffagent_locations = (ensemble.type_occupancy(us.FastFoodAgent.code) > 0).astype(float)
+		gsagent_locations = (ensemble.type_occupancy(us.GroceryStoreAgent.code) > 0).astype(float)
+		for k in range(lanes):
+			yield (externality_quintiles[k], ensemble.mobility[k].copy(), ensemble.income[k].copy(),
+			       ffagent_locations[k], gsagent_locations[k])
+
+#evaluates each of a list of parameter sets (e.g. parameters.latin_hypercube) on one replicate,
+#all advanced together as ensemble lanes, and yields their summaries in order
+def parameter_summaries(parameter_sets, grid_size, rent_ceiling, create_rule, distribution, randomize = True, steps = 100, seed = None, memory_budget = 2**28):
+	parameter_sets = list(parameter_sets)
+	return ensemble_summaries(len(parameter_sets), grid_size, rent_ceiling, create_rule, distribution, randomize,
+				  steps, seed, memory_budget, stack(parameter_sets))
@@ -0,0 +1,174 @@
+'''
+Array kernels shared by the UrbanScape update methods
+'''
+
+import numpy as np
+
+#-------------------------------
+# Windowed (box filter) sums   |
+#-------------------------------
+
+#builds the integral image of a grid: table[...,i,j] is the sum of grid[...,:i,:j].
+#the table has one extra leading row and column of zeros so that window sums need no special cases
+def summed_area_table(grid):
+	grid = np.asarray(grid, dtype=float)
+	shape = grid.shape[:-2] + (grid.shape[-2]+1, grid.shape[-1]+1)
+	table = np.zeros(shape)
+	np.cumsum(grid, axis=-2, out=table[...,1:,1:])
+	np.cumsum(table[...,1:,1:], axis=-1, out=table[...,1:,1:])
+	return table
+
+#lower and upper (exclusive) bounds of the windows of given radius centred on each index,
+#clipped to the edges of an axis of length n
+def window_bounds(n, radius):
+	idx = np.arange(n)
+	lo = np.clip(idx - radius, 0, n)
+	hi = np.clip(idx + radius + 1, 0, n)
+	return lo, hi
+
+#sum of every block's (2r+1)x(2r+1) neighbourhood over the last two axes.
+#blocks outside of the grid count as zero, which matches the bounds checks on effect_coordinates
+def window_sum(grid, radius):
+	table = summed_area_table(grid)
+	rlo, rhi = window_bounds(table.shape[-2]-1, radius)
+	clo, chi = window_bounds(table.shape[-1]-1, radius)
+	rlo, rhi = rlo[:,None], rhi[:,None]
+	clo, chi = clo[None,:], chi[None,:]
+	return table[...,rhi,chi] - table[...,rlo,chi] - table[...,rhi,clo] + table[...,rlo,clo]
+
+#window_sum over a stack of grids (lanes, ..., N, N) with a radius per lane; radius may also be a single int
+def lane_window_sum(grid, radius):
+	radius = np.asarray(radius)
+	if radius.ndim == 0:
+		return window_sum(grid, int(radius))
+	radius = radius.ravel()
+	out = np.empty(grid.shape)
+	for r in np.unique(radius):
+		lanes = radius == r
+		out[lanes] = window_sum(grid[lanes], int(r))
+	return out
+
+#sum of the (2r+1)x(2r+1) window centred on block (x,y), read from a summed_area_table
+#with four corner lookups. x and y may also be arrays of block coordinates.
+#for a stack of tables (one per ensemble lane) lane gives the table each block is read from
+def window_lookup(table, x, y, radius, lane = None):
+	n, m = table.shape[-2]-1, table.shape[-1]-1
+	x0, x1 = np.clip(x - radius, 0, n), np.clip(x + radius + 1, 0, n)
+	y0, y1 = np.clip(y - radius, 0, m), np.clip(y + radius + 1, 0, m)
+	if lane is not None:
+		return table[lane,x1,y1] - table[lane,x0,y1] - table[lane,x1,y0] + table[lane,x0,y0]
+	return table[...,x1,y1] - table[...,x0,y1] - table[...,x1,y0] + table[...,x0,y0]
+
+#-------------------------------
+# Distance fields              |
+#-------------------------------
+
+#euclidean distance from every block of a grid of the given shape to the point centre = (i,j).
+#i and j may also be arrays giving the centre row for each row and the centre column for each
+#column, which measures each block from a centre picked separately along the two axes
+def centre_distance(shape, centre):
+	di = np.arange(shape[0], dtype=float) - centre[0]
+	dj = np.arange(shape[1], dtype=float) - centre[1]
+	distance = di[:,None]**2 + dj[None,:]**2
+	return np.sqrt(distance, out=distance)
+
+#distance from every block to the nearest of the centres
+def distance_field(shape, centres):
+	field = centre_distance(shape, centres[0])
+	for centre in centres[1:]:
+		np.minimum(field, centre_distance(shape, centre), out=field)
+	return field
+
+#-------------------------------
+# Income Quintiles             |
+#-------------------------------
+
+#mean of values over the blocks of each income quintile, for a grid or a stack of grids (..., N, N).
+#quintiles are taken over the distinct income values: with the num distinct values sorted, the cutoffs
+#are int(num/5*k - 1) for k = 1..5 and quintile q holds the values ranked in [cutoff q-1, cutoff q),
+#starting from rank 0. blocks ranked at or above the last cutoff (the top income) belong to no quintile.
+#returns an array of shape (..., 5); a quintile with no blocks gives nan
+def quintile_means(income, values):
+	income = np.asarray(income, dtype=float)
+	lead = income.shape[:-2]
+	grids = int(np.prod(lead))
+	blocks = income.shape[-2] * income.shape[-1]
+	income = income.reshape(grids, blocks)
+	values = np.asarray(values, dtype=float).reshape(grids, blocks)
+
+	#dense rank of every block's income within its grid
+	order = np.argsort(income, axis=1, kind='mergesort')
+	ordered = income[np.arange(grids)[:,None], order]
+	distinct = np.ones((grids, blocks), dtype=int)
+	distinct[:,1:] = ordered[:,1:] != ordered[:,:-1]
+	dense = np.cumsum(distinct, axis=1) - 1
+	ranks = np.empty_like(dense)
+	ranks[np.arange(grids)[:,None], order] = dense
+	num = dense[:,-1] + 1
+
+	cutoffs = np.trunc(num[:,None] / 5.0 * np.arange(1,6) - 1).astype(int)
+	quintile = (ranks[:,:,None] >= cutoffs[:,None,:4]).sum(axis=2)
+	quintile[ranks >= cutoffs[:,4:5]] = 5	#overflow bin, dropped below
+
+	bins = (np.arange(grids)[:,None] * 6 + quintile).ravel()
+	totals = np.bincount(bins, weights=values.ravel(), minlength=grids * 6).reshape(grids, 6)
+	counts = np.bincount(bins, minlength=grids * 6).reshape(grids, 6)
+	with np.errstate(invalid='ignore', divide='ignore'):
+		means = totals[:,:5] / counts[:,:5]
+	return means.reshape(lead + (5,))
+
+#-------------------------------
+# Dirty-tile bookkeeping       |
+#-------------------------------
+
+#number of tiles of the given side needed to cover an axis of length n
+def tile_count(n, tile):
+	return -(-n // tile)
+
+#for each tile x tile square of a 2D boolean grid, whether any of its blocks is True
+def tile_any(mask, tile):
+	n, m = mask.shape
+	padded = np.zeros((tile_count(n, tile) * tile, tile_count(m, tile) * tile), dtype=bool)
+	padded[:n,:m] = mask
+	return padded.reshape(padded.shape[0] // tile, tile, padded.shape[1] // tile, tile).any(axis=(1,3))
+
+#the (row slice, column slice) region of the grid covered by tile (ti,tj)
+def tile_region(ti, tj, tile):
+	return (slice(ti * tile, (ti+1) * tile), slice(tj * tile, (tj+1) * tile))
+
+#the range of tiles overlapped by the blocks lo..hi-1 of an axis
+def tile_span(lo, hi, tile):
+	return range(lo // tile, (hi - 1) // tile + 1)
+
+#-------------------------------
+# Block reduction              |
+#-------------------------------
+
+#number of blocks of the axis of length n that fall into each of its factor-wide bins
+def bin_sizes(n, factor):
+	return np.minimum(factor, n - np.arange(tile_count(n, factor)) * factor)
+
+#reduces every factor x factor bin of the last two axes to one value with how: 'sum', 'mean',
+#'max' or 'mode' (the most common value, the lowest on ties). bins at the far edges that are
+#only partly covered by the grid aggregate the blocks they do hold
+def block_reduce(grid, factor, how = 'mean'):
+	grid = np.asarray(grid)
+	if how == 'mode':
+		codes = np.unique(grid)
+		counts = np.array([block_reduce(grid == code, factor, 'sum') for code in codes])
+		return codes[np.argmax(counts, axis=0)]
+
+	n, m = grid.shape[-2:]
+	rows, cols = tile_count(n, factor), tile_count(m, factor)
+	fill, dtype = (-np.inf, float) if how == 'max' else (0, np.result_type(grid.dtype, np.int64))
+	padded = np.full(grid.shape[:-2] + (rows * factor, cols * factor), fill, dtype=dtype)
+	padded[...,:n,:m] = grid
+	bins = padded.reshape(grid.shape[:-2] + (rows, factor, cols, factor))
+	if how == 'max':
+		return bins.max(axis=(-3,-1))
+	totals = bins.sum(axis=(-3,-1))
+	if how == 'sum':
+		return totals
+	if how == 'mean':
+		return totals / (bin_sizes(n, factor)[:,None] * bin_sizes(m, factor)[None,:]).astype(float)
+	raise ValueError('unknown block reduction ' + repr(how))
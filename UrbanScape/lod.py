@@ -0,0 +1,63 @@
+'''
+Level-of-detail reduction of UrbanScape grids for display
+'''
+
+import numpy as np
+import kernels
+
+# Grids larger than the display are reduced to about resolution cells per side before they
+# are drawn, and colour limits follow the reduced frames instead of rescanning full grids.
+
+default_resolution = 512
+
+#how the blocks sharing one displayed cell are combined: levels are averaged, exposures keep
+#their worst block so that hot spots stay visible, and location codes keep the most common code
+field_aggregations = {'income': 'mean',
+		      'rent': 'mean',
+		      'mobility': 'mean',
+		      'externalities': 'max',
+		      'ffcapture_number': 'max',
+		      'gscapture_number': 'max',
+		      'agent_locations': 'mode'}
+
+#how many blocks per side are combined into one displayed cell (resolution None keeps every block)
+def reduction_factor(shape, resolution = default_resolution):
+	if resolution is None:
+		return 1
+	return max(1, kernels.tile_count(max(shape[-2:]), resolution))
+
+#a grid (or stack of grids) of the named field reduced to at most resolution cells per side
+def downsample_field(name, grid, resolution = default_resolution):
+	grid = np.asarray(grid)
+	factor = reduction_factor(grid.shape, resolution)
+	if factor == 1:
+		return grid
+	return kernels.block_reduce(grid, factor, field_aggregations.get(name, 'mean'))
+
+#the imshow extent of a full grid, so that a reduced image keeps the block coordinates of its axes
+def grid_extent(shape):
+	n, m = shape[-2:]
+	return (-0.5, m - 0.5, n - 0.5, -0.5)
+
+class ColorLimits(object):
+	# Colour limits of an image that only widen when a frame goes beyond them, so each
+	# update costs one min/max over the (reduced) frame and a redraw of the colour scale only when they move.
+	def __init__(self, vmin = None, vmax = None):
+		self.vmin = vmin
+		self.vmax = vmax
+
+	#widens the limits to cover frame; returns True if they changed
+	def update(self, frame):
+		lo, hi = float(np.nanmin(frame)), float(np.nanmax(frame))
+		changed = False
+		if self.vmin is None or lo < self.vmin:
+			self.vmin, changed = lo, True
+		if self.vmax is None or hi > self.vmax:
+			self.vmax, changed = hi, True
+		return changed
+
+	#sets the image's data to frame, and its colour limits if they moved
+	def apply(self, image, frame):
+		image.set_array(frame)
+		if self.update(frame):
+			image.set_clim(self.vmin, self.vmax)
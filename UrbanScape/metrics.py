@@ -0,0 +1,69 @@
+'''
+Per-step metric observers and the streaming experiment loop
+'''
+
+import numpy as np
+import kernels
+
+#---------------
+# Observers    |
+#---------------
+
+class Observer(object):
+	# A named metric computed from the urbanscape after every step whose time is a multiple of every.
+	# function takes the urbanscape and should return a value that does not alias its live arrays.
+	def __init__(self, name, function, every = 1):
+		self.name = name
+		self.function = function
+		self.every = every
+
+	def due(self, time):
+		return time % self.every == 0
+
+#accepts Observer instances or (name, function) / (name, function, every) tuples
+def as_observers(observers):
+	return [observer if isinstance(observer, Observer) else Observer(*observer) for observer in observers]
+
+#-------------------
+# Metric Functions |
+#-------------------
+
+#mean externality exposure of each income quintile
+def quintile_exposure(urbanscape):
+	return kernels.quintile_means(urbanscape.income, urbanscape.externalities)
+
+def mean_mobility(urbanscape):
+	return urbanscape.mobility.mean(axis=(-2,-1))
+
+def mean_externality(urbanscape):
+	return urbanscape.externalities.mean(axis=(-2,-1))
+
+#number of live agents of each type code
+def agent_counts(urbanscape):
+	return urbanscape.occupancy.sum(axis=(-2,-1))
+
+#a metric function returning a copy of one of the urbanscape's grids, e.g. grid_snapshot('income')
+def grid_snapshot(field):
+	def snapshot(urbanscape):
+		return np.array(getattr(urbanscape, field))
+	snapshot.__name__ = field + '_snapshot'
+	return snapshot
+
+#--------------------
+# Streaming Loop    |
+#--------------------
+
+#steps the urbanscape and yields a record after every step: a dict holding the urbanscape's time
+#and the value of each observer due at that time. runs forever if steps is None.
+#nothing is kept between records, so memory stays constant however long the run is consumed
+def observe(urbanscape, steps = None, observers = ()):
+	observers = as_observers(observers)
+	taken = 0
+	while steps is None or taken < steps:
+		urbanscape.step()
+		taken += 1
+		record = {'time': urbanscape.time}
+		for observer in observers:
+			if observer.due(urbanscape.time):
+				record[observer.name] = observer.function(urbanscape)
+		yield record
@@ -0,0 +1,158 @@
+'''
+Behavioural constants of the UrbanScape model, per simulation or per ensemble lane
+'''
+
+import numpy as np
+
+#------------------------
+# Model Constants       |
+#------------------------
+
+# (name, default) of the constants of the update methods and create rules
+model_constants = (('fafh_a1', 1.5802),		#food away from home per block: a1 * income**b1 * income
+		   ('fafh_b1', -0.32),
+		   ('ffr_a2', 5.528e-6),		#fast food share of food away from home: -(a2 * income + b2)**2 + c2, at least 0.075
+		   ('ffr_b2', -0.332),
+		   ('ffr_c2', 0.40),
+		   ('fah_a1', 73.969),		#food at home (groceries) per block: a1 * income**b1 * income
+		   ('fah_b1', -0.632),
+		   ('heal_rate', 0.95),		#externalities heal by this factor where ff - gs capture is zero
+		   ('a3', 0.75),			#mobility: a3 + (1 - a3) / (1 + b3**(E - c3)) for externalities E
+		   ('b3', 1.5),
+		   ('c3', 50.0),
+		   ('prob_max', 0.15))		#create probability at the block with the best profit margin
+
+# constants of every registered food agent type, named <label>_<constant> (e.g. FF_operations),
+# whose defaults are the class attributes of the agent type
+agent_constants = ('operations', 'initial_wealth', 'radius')
+
+def agent_parameter_name(agent_type, name):
+	return agent_type.label + '_' + name
+
+def default_values():
+	import urbanscape as us
+	values = dict(model_constants)
+	for agent_type in us.agent_types:
+		for name in agent_constants:
+			values[agent_parameter_name(agent_type, name)] = getattr(agent_type, name)
+	return values
+
+#a per-lane value (an array) shaped to broadcast against arrays with a leading lane axis and ndim axes
+def lane_broadcast(value, ndim = 3):
+	if isinstance(value, np.ndarray):
+		return value.reshape((-1,) + (1,) * (ndim - 1))
+	return value
+
+class ModelParameters(object):
+	# The model constants of one simulation, readable as attributes (parameters.heal_rate).
+	# Any value may instead be an array of one value per lane of an UrbanScapeEnsemble,
+	# so that every lane runs with its own parameter vector.
+	def __init__(self, **values):
+		defaults = default_values()
+		unknown = set(values) - set(defaults)
+		if unknown:
+			raise ValueError('unknown model parameters ' + ', '.join(sorted(unknown)))
+		self.values = defaults
+		for name, value in values.items():
+			if isinstance(value, (list, tuple, np.ndarray)):
+				value = np.array(value)
+			self.values[name] = value
+
+	def __getattr__(self, name):
+		try:
+			return self.__dict__['values'][name]
+		except KeyError:
+			raise AttributeError(name)
+
+	def __getstate__(self):
+		return self.values
+
+	def __setstate__(self, values):
+		self.values = values
+
+	#every parameter name, model constants first
+	def names(self):
+		extra = sorted(set(self.values) - set(dict(model_constants)))
+		return [name for name, _ in model_constants] + extra
+
+	#a constant, shaped to broadcast over (lane,) + ndim - 1 trailing axes if it varies by lane
+	def get(self, name, ndim = 3):
+		return lane_broadcast(self.values[name], ndim)
+
+	#a constant of a food agent type, e.g. parameters.agent(FastFoodAgent, 'operations')
+	def agent(self, agent_type, name, ndim = 3):
+		return self.get(agent_parameter_name(agent_type, name), ndim)
+
+	#number of lanes the values are given for, or None if every value is a scalar
+	def lanes(self):
+		sizes = set(len(value) for value in self.values.values() if isinstance(value, np.ndarray))
+		if len(sizes) > 1:
+			raise ValueError('per-lane model parameters of different lengths ' + repr(sorted(sizes)))
+		return sizes.pop() if sizes else None
+
+	#the scalar parameters of lane k
+	def lane(self, k):
+		return ModelParameters(**dict((name, value[k].item() if isinstance(value, np.ndarray) else value)
+					      for name, value in self.values.items()))
+
+	#the parameters of a subset of the lanes (a slice or an index array); scalar values are shared
+	def select(self, lanes):
+		return ModelParameters(**dict((name, value[lanes] if isinstance(value, np.ndarray) else value)
+					      for name, value in self.values.items()))
+
+	#a copy with some values changed
+	def replace(self, **values):
+		updated = dict(self.values)
+		updated.update(values)
+		return ModelParameters(**updated)
+
+	#all values (per-lane values as lists), e.g. for JSON
+	def as_dict(self):
+		return dict((name, value.tolist() if isinstance(value, np.ndarray) else value)
+			    for name, value in self.values.items())
+
+	#the values that differ from the defaults
+	def changes(self):
+		defaults = default_values()
+		return dict((name, value) for name, value in self.as_dict().items()
+			    if isinstance(value, list) or value != defaults.get(name))
+
+	def __repr__(self):
+		return 'ModelParameters(%s)' % ', '.join('%s=%r' % item for item in sorted(self.changes().items()))
+
+#one ModelParameters holding a list of parameter sets as per-lane values (lane k = parameter_sets[k]).
+#constants that are the same in every set stay scalars
+def stack(parameter_sets):
+	parameter_sets = list(parameter_sets)
+	if any(p.lanes() is not None for p in parameter_sets):
+		raise ValueError('stack takes parameter sets of scalar values, not per-lane values')
+	values = {}
+	for name in parameter_sets[0].values:
+		lane_values = [p.values[name] for p in parameter_sets]
+		if all(value == lane_values[0] for value in lane_values):
+			values[name] = lane_values[0]
+		else:
+			values[name] = np.array(lane_values)
+	return ModelParameters(**values)
+
+#------------------------
+# Sampling              |
+#------------------------
+
+#a Latin hypercube sample of parameter sets: ranges maps parameter names to (low, high), each range is
+#split into samples strata and every stratum is used once per parameter. agent radii are rounded
+#to integers. base gives the values of the parameters that aren't sampled
+def latin_hypercube(ranges, samples, random_state = None, base = None):
+	if random_state is None:
+		random_state = np.random.RandomState()
+	if base is None:
+		base = ModelParameters()
+	columns = {}
+	for name in sorted(ranges):
+		low, high = ranges[name]
+		strata = (random_state.permutation(samples) + random_state.random_sample(samples)) / samples
+		values = low + strata * (high - low)
+		if name.endswith('_radius'):
+			values = np.rint(values).astype(int)
+		columns[name] = values
+	return [base.replace(**dict((name, columns[name][k].item()) for name in columns)) for k in range(samples)]
@@ -0,0 +1,132 @@
+'''
+Plots of UrbanScape state and experiment results. This is the only module of the
+simulation core that imports matplotlib, and urbanscape only imports it on first use
+'''
+
+import numpy as np
+import matplotlib.pyplot as pyplot
+import accumulators
+import lod
+
+#---------------------------------------
+# Functions for Visualizing UrbanScape |
+#---------------------------------------
+
+#grids larger than resolution blocks per side are drawn at reduced detail (see lod.downsample_field)
+def plot_urbanscape(urbanscape, resolution = lod.default_resolution):
+	fig = pyplot.figure()
+	
+	pyplot.clf()
+	pyplot.subplot(221)
+	ii = urbanscape.income
+	pyplot.imshow(lod.downsample_field('income', ii, resolution), extent=lod.grid_extent(ii.shape), interpolation='nearest')
+	pyplot.title("Income Distribution")
+	pyplot.subplot(221).axes.get_xaxis().set_ticks([])
+	pyplot.subplot(221).axes.get_yaxis().set_ticks([])
+
+	pyplot.subplot(222)
+	ff = urbanscape.ffcapture_number
+	pyplot.imshow(lod.downsample_field('ffcapture_number', ff, resolution), extent=lod.grid_extent(ff.shape), cmap = 'YlOrRd', interpolation='nearest')
+	pyplot.title("FFR Effect Radii")
+	pyplot.subplot(222).axes.get_xaxis().set_ticks([])
+	pyplot.subplot(222).axes.get_yaxis().set_ticks([])
+
+	pyplot.subplot(223)
+	mm = urbanscape.externalities
+	pyplot.imshow(lod.downsample_field('externalities', mm, resolution), extent=lod.grid_extent(mm.shape), cmap = 'Purples', interpolation='nearest')
+	pyplot.title("Negative Externalities")
+	pyplot.subplot(223).axes.get_xaxis().set_ticks([])
+	pyplot.subplot(223).axes.get_yaxis().set_ticks([])
+	
+	pyplot.subplot(224)
+	ll = urbanscape.agent_locations
+	pyplot.imshow(lod.downsample_field('agent_locations', ll, resolution), extent=lod.grid_extent(ll.shape), cmap = 'RdYlGn', interpolation='nearest',vmin=-1,vmax=1)
+	pyplot.title("Food Agent Locations")
+	pyplot.subplot(224).axes.get_xaxis().set_ticks([])
+	pyplot.subplot(224).axes.get_yaxis().set_ticks([])
+	
+	#return fig
+
+#---------------------------------------
+# Experiment Results                   |
+#---------------------------------------
+
+#plots the averages returned by urbanscape.run_batch_experiments
+#averages is the tuple returned by run_batch_experiments, or the accumulators.BatchStatistics of
+#run_batch_statistics, which also draws the level confidence band of each quintile's exposure
+def plot_batch_experiments(averages, level = 0.95):
+	bands = None
+	if isinstance(averages, accumulators.BatchStatistics):
+		bands = averages['externalities'].confidence_interval(level)
+		averages = averages.means()
+	avg_externalities, avg_terminal_mobility, avg_terminal_income, avg_ffagent_locations, avg_gsagent_locations = averages
+	
+	ax1 = pyplot.subplot(321)
+	pyplot.plot(avg_externalities[0], color = 'm', label = 'low-income',linewidth=2.0)
+	pyplot.plot(avg_externalities[1], color = 'r', label = 'low-middle income',linewidth=2.0)
+	pyplot.plot(avg_externalities[2], color = 'y', label = 'middle income',linewidth=2.0)
+	pyplot.plot(avg_externalities[3], color = 'g', label = 'middle-high income',linewidth=2.0)
+	pyplot.plot(avg_externalities[4], color = 'b', label = 'high income',linewidth=2.0)
+	if bands is not None and np.isfinite(bands[0]).all():
+		time = np.arange(avg_externalities.shape[1])
+		for q, color in enumerate('mrygb'):
+			pyplot.fill_between(time, bands[0][q], bands[1][q], color = color, alpha = 0.2, linewidth = 0)
+	pyplot.legend(bbox_to_anchor=(1.05, 1), loc=2, prop={'size':7}, borderaxespad=0.)
+
+	pyplot.xlabel('time',fontsize=10,fontname='serif')
+	pyplot.ylabel('total exposure',fontsize=10,fontname='serif')
+	pyplot.title('Accumulation of Negative Externalities',fontsize=10,fontname='serif')
+	
+	ax2 = pyplot.subplot(323)
+	pyplot.imshow(avg_terminal_income, interpolation='nearest')
+	pyplot.title('Terminal Income Distribution',fontsize=10,fontname='serif')
+	
+	ax3 = pyplot.subplot(324)
+	pyplot.imshow(avg_terminal_mobility, cmap = 'Purples', interpolation='nearest')
+	pyplot.title('Terminal Mobility Distribution',fontsize=10,fontname='serif')
+	
+	ax4 = pyplot.subplot(325)
+	pyplot.imshow(avg_ffagent_locations, cmap = 'Reds', interpolation='nearest')
+	pyplot.title('Fast Food Agent Locations',fontsize=10,fontname='serif')
+	
+	ax5 = pyplot.subplot(326)
+	pyplot.imshow(avg_gsagent_locations, cmap = 'Greens', interpolation='nearest')
+	pyplot.title('Grocery Store Agent Locations',fontsize=10,fontname='serif')
+	
+	ax1.tick_params(axis='x',labelsize=9)
+        ax1.tick_params(axis='y',labelsize=9)
+	ax2.tick_params(axis='x',labelsize=9)
+        ax2.tick_params(axis='y',labelsize=9)
+        ax3.tick_params(axis='x',labelsize=9)
+        ax3.tick_params(axis='y',labelsize=9)
+        ax4.tick_params(axis='x',labelsize=9)
+        ax4.tick_params(axis='y',labelsize=9)
+        ax5.tick_params(axis='x',labelsize=9)
+        ax5.tick_params(axis='y',labelsize=9)
+	
+	pyplot.show()
+
+def plot_experiment(externality_quintiles, urbanscape, resolution = lod.default_resolution):
+	pyplot.subplot(221)
+	pyplot.plot(externality_quintiles[0], color = 'm', label = 'low-income',linewidth=2.0)
+	pyplot.plot(externality_quintiles[1], color = 'r', label = 'low-middle income',linewidth=2.0)
+	pyplot.plot(externality_quintiles[2], color = 'y', label = 'middle income',linewidth=2.0)
+	pyplot.plot(externality_quintiles[3], color = 'g', label = 'middle-high income',linewidth=2.0)
+	pyplot.plot(externality_quintiles[4], color = 'b', label = 'high income',linewidth=2.0)
+	pyplot.legend(bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0.)
+
+	pyplot.xlabel('time')
+	pyplot.ylabel('total exposure')
+	pyplot.title('Accumulation of Negative Externalities')
+	
+	pyplot.subplot(223)
+	pyplot.imshow(lod.downsample_field('income', urbanscape.income, resolution), interpolation='nearest',
+		      extent=lod.grid_extent(urbanscape.income.shape))
+	pyplot.title('Income Distribution')
+	
+	pyplot.subplot(224)
+	locations = urbanscape.agent_locations
+	pyplot.imshow(lod.downsample_field('agent_locations', locations, resolution), cmap = 'YlOrRd', interpolation='nearest',
+		      extent=lod.grid_extent(locations.shape))
+	pyplot.title('Fast Food Locations')
+	pyplot.show()
@@ -0,0 +1,76 @@
+'''
+Seeded random streams owned by each UrbanScape
+'''
+
+import numpy as np
+
+#------------------
+# Seeding Scheme  |
+#------------------
+
+# A seed is an int or a tuple of ints. Each urbanscape derives one independent
+# stream per purpose from its seed by appending the stream number, and replicate k
+# of an experiment with seed s is seeded with (s, k). RandomState seeds the
+# Mersenne Twister from the whole sequence, so every (seed, stream) pair gives its own state.
+
+GRID_STREAM = 0		#bulk per-block draws: rent, randomization and expenditure multipliers
+DECISION_STREAM = 1	#scalar draws of the create rules
+ENSEMBLE_GRID_STREAM = 2	#per-block draws of all the lanes of an ensemble at once
+ENSEMBLE_DECISION_STREAM = 3	#per-lane create rule draws of an ensemble
+
+#a new seed taken from operating system entropy, so that unseeded runs can still be repeated
+def fresh_seed():
+	return int(np.random.RandomState().randint(2**31 - 1))
+
+def seed_sequence(seed):
+	if isinstance(seed, (tuple, list)):
+		return [int(s) for s in seed]
+	return [int(seed)]
+
+def stream_state(seed, stream):
+	return np.random.RandomState(seed_sequence(seed) + [stream])
+
+#seeds of the independent, reproducible replicates of an experiment
+def replicate_seeds(seed, count):
+	return [tuple(seed_sequence(seed)) + (k,) for k in range(count)]
+
+#----------------------
+# Buffered Stream     |
+#----------------------
+
+class RandomStream(object):
+	# Uniform floats drawn from a RandomState in blocks of block_size and
+	# handed out one at a time, so scalar decisions don't pay a generator call each.
+	def __init__(self, random_state, block_size = 1024):
+		self.random_state = random_state
+		self.block_size = block_size
+		self.buffer = np.empty(0)
+		self.position = 0
+
+	def refill(self):
+		self.buffer = self.random_state.random_sample(self.block_size)
+		self.position = 0
+
+	#a float in [0, 1)
+	def random(self):
+		if self.position == len(self.buffer):
+			self.refill()
+		value = self.buffer[self.position]
+		self.position += 1
+		return float(value)
+
+	rand = random
+
+	#an integer in [low, high)
+	def randint(self, low, high):
+		return min(int(low + self.random() * (high - low)), high - 1)
+
+	#state of the stream (generator state plus the unread part of the buffer) and its inverse
+	def get_state(self):
+		return self.random_state.get_state(), self.buffer.copy(), self.position
+
+	def set_state(self, state):
+		random_state, buffer, position = state
+		self.random_state.set_state(random_state)
+		self.buffer = np.array(buffer, dtype=float)
+		self.position = int(position)
@@ -0,0 +1,265 @@
+'''
+Parameter sweeps over UrbanScape configurations, run on a worker pool and resumable
+'''
+
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+import urbanscape as us
+from parameters import ModelParameters
+
+# A parameter space maps run_batch_experiments arguments to the values to sweep. Every combination
+# is one job, identified by a hash of its configuration. A sweep directory holds a journal.jsonl
+# with one line per finished job and a results/<job id>.npz with its averages, so an interrupted
+# sweep is resumed by running it again: the jobs already in the journal are skipped.
+
+#the parameters of a job and their defaults. constants overrides model constants for the job, by
+#their parameters.ModelParameters name, e.g. {'FF_operations': 60000, 'heal_rate': 0.9}, or other
+#class-level constants by their dotted name, e.g. {'UrbanScape.population_per_block': 25}.
+#targets makes a job stop adaptively (see urbanscape.run_adaptive_statistics): batches replicates
+#are run first, then more until the precision targets, e.g. [us.exposure_target(0.5)], are met
+#or max_batches (by default 10 * batches) have run
+job_defaults = {'grid_size': 20,
+		'rent_ceiling': 250000,
+		'create_rule': 'profit_probability_create_rule',
+		'distribution': 'CBD',
+		'randomize': True,
+		'steps': 100,
+		'batches': 1,
+		'constants': {},
+		'targets': None,
+		'max_batches': None}
+
+#parameters left out of a job's configuration (and so of its id) while they are None,
+#which keeps the ids of jobs configured before they existed
+optional_parameters = ('targets', 'max_batches')
+
+result_names = ('externalities', 'mobility', 'income', 'ffagent_locations', 'gsagent_locations')
+
+#------------------
+# Job Expansion   |
+#------------------
+
+def canonical(config):
+	return json.dumps(config, sort_keys=True, separators=(',',':'))
+
+def job_id(config):
+	return hashlib.sha1(canonical(config)).hexdigest()[:16]
+
+#the most replicates a job can run: batches, or max_batches for a job with targets
+def job_max_batches(config):
+	if config.get('targets'):
+		return config.get('max_batches') or 10 * config['batches']
+	return config['batches']
+
+#relative cost of a job, for scheduling and the ETA. a job with targets is costed at its
+#max_batches, the most it can run, since how soon it meets its targets isn't known up front
+def job_cost(config):
+	return config['grid_size']**2 * config['steps'] * job_max_batches(config)
+
+#expands a parameter space into its job configurations, longest first. each value of space is either
+#a list of the values to sweep or a single value (so a list valued parameter, like a list of
+#business district centres, has to be given inside another list). unspecified parameters take
+#job_defaults, create rules may be given as functions or by name
+def expand_space(space):
+	unknown = set(space) - set(job_defaults)
+	if unknown:
+		raise ValueError('unknown sweep parameters ' + ', '.join(sorted(unknown)))
+	names = sorted(job_defaults)
+	axes = []
+	for name in names:
+		values = space.get(name, job_defaults[name])
+		axes.append(values if isinstance(values, list) else [values])
+
+	configs = []
+	seen = set()
+	for values in itertools.product(*axes):
+		config = dict(zip(names, values))
+		for name in optional_parameters:
+			if config[name] is None:
+				del config[name]
+		if callable(config['create_rule']):
+			config['create_rule'] = config['create_rule'].__name__
+		config = json.loads(canonical(config))	#tuples become lists, as they will be in the journal
+		if job_id(config) not in seen:	#axes can give the same configuration more than once
+			seen.add(job_id(config))
+			configs.append(config)
+	configs.sort(key=job_cost, reverse=True)
+	return configs
+
+#------------------
+# Running Jobs    |
+#------------------
+
+def resolve_constant(name):
+	owner, attribute = name.rsplit('.', 1)
+	return getattr(us, owner), attribute
+
+#runs one job in the current process and returns (job id, averages, seconds taken, replicates run).
+#the replicates of a job are seeded from (seed, the first 8 hex digits of its id), so a job
+#gives the same result whatever sweep or order it runs in
+def run_job(arguments):
+	config, seed = arguments
+	overrides = [resolve_constant(name) + (value,) for name, value in sorted(config['constants'].items()) if '.' in name]
+	saved = [(owner, attribute, getattr(owner, attribute)) for owner, attribute, value in overrides]
+	start = time.time()
+	try:
+		for owner, attribute, value in overrides:
+			setattr(owner, attribute, value)
+		parameters = ModelParameters(**dict((name, value) for name, value in config['constants'].items() if '.' not in name))
+		experiment = (config['grid_size'], config['rent_ceiling'], getattr(us, config['create_rule']),
+			     config['distribution'], config['randomize'], config['steps'])
+		job_seed = (seed, int(job_id(config)[:8], 16))
+		if config.get('targets'):
+			statistics = us.run_adaptive_statistics(config['targets'], *experiment, seed = job_seed,
+								min_batches = config['batches'],
+								max_batches = job_max_batches(config),
+								parameters = parameters)[0]
+		else:
+			statistics = us.run_batch_statistics(config['batches'], *experiment, seed = job_seed, parameters = parameters)
+	finally:
+		for owner, attribute, value in saved:
+			setattr(owner, attribute, value)
+	return job_id(config), statistics.means(), time.time() - start, statistics.count
+
+#------------------
+# Progress        |
+#------------------
+
+class SweepProgress(object):
+	# Jobs and cost done so far, the throughput since the sweep (re)started and the time left at that rate
+	def __init__(self, configs, done):
+		self.total = len(configs)
+		self.done = len([config for config in configs if job_id(config) in done])
+		self.total_cost = sum(job_cost(config) for config in configs)
+		self.remaining_cost = sum(job_cost(config) for config in configs if job_id(config) not in done)
+		self.started = time.time()
+		self.finished = 0
+		self.finished_cost = 0
+
+	def update(self, config):
+		self.done += 1
+		self.finished += 1
+		self.finished_cost += job_cost(config)
+		self.remaining_cost -= job_cost(config)
+
+	def elapsed(self):
+		return time.time() - self.started
+
+	#jobs finished per second in this run
+	def throughput(self):
+		return self.finished / max(self.elapsed(), 1e-9)
+
+	#seconds left, extrapolated from the cost finished per second in this run
+	def eta(self):
+		if self.finished_cost == 0:
+			return float('nan')
+		return self.remaining_cost * self.elapsed() / self.finished_cost
+
+	def __str__(self):
+		return '%d/%d jobs, %.3g jobs/s, eta %s' % (self.done, self.total, self.throughput(), format_seconds(self.eta()))
+
+def format_seconds(seconds):
+	if seconds != seconds:
+		return '?'
+	minutes, seconds = divmod(int(round(seconds)), 60)
+	hours, minutes = divmod(minutes, 60)
+	return '%d:%02d:%02d' % (hours, minutes, seconds)
+
+def print_progress(progress):
+	sys.stderr.write(str(progress) + '\n')
+
+#------------------
+# Sweeps          |
+#------------------
+
+#ids of the jobs recorded as finished in a sweep directory
+def finished_jobs(directory):
+	path = os.path.join(directory, 'journal.jsonl')
+	if not os.path.exists(path):
+		return set()
+	done = set()
+	with open(path) as f:
+		for line in f:
+			try:
+				done.add(json.loads(line)['id'])
+			except ValueError:
+				pass	#a line cut short when the sweep was killed
+	return done
+
+def save_result(directory, config, averages, seconds, replicates):
+	identifier = job_id(config)
+	path = os.path.join(directory, 'results', identifier + '.npz')
+	with open(path + '.partial', 'wb') as f:
+		np.savez(f, **dict(zip(result_names, averages)))
+	os.rename(path + '.partial', path)
+	with open(os.path.join(directory, 'journal.jsonl'), 'a') as f:
+		f.write(json.dumps({'id': identifier, 'config': config, 'seconds': seconds, 'replicates': replicates}) + '\n')
+
+#runs every job of the parameter space that the sweep directory doesn't already hold, longest first,
+#on a pool of processes workers (all cores by default). progress is called with a SweepProgress
+#after each job finishes; with jobs that have targets its eta is an upper bound, as they are costed
+#at their max_batches and usually stop sooner. returns the ids of the jobs of the space
+def run_sweep(space, directory, processes = None, seed = 0, progress = print_progress):
+	configs = expand_space(space)
+	if not os.path.isdir(os.path.join(directory, 'results')):
+		os.makedirs(os.path.join(directory, 'results'))
+	done = finished_jobs(directory)
+	pending = [config for config in configs if job_id(config) not in done]
+	status = SweepProgress(configs, done)
+	by_id = dict((job_id(config), config) for config in pending)
+
+	if processes is None:
+		processes = multiprocessing.cpu_count()
+	jobs = [(config, seed) for config in pending]
+	if processes > 1 and len(jobs) > 1:
+		pool = multiprocessing.Pool(processes)
+		results = pool.imap_unordered(run_job, jobs)
+	else:
+		pool = None
+		results = itertools.imap(run_job, jobs)
+
+	try:
+		for identifier, averages, seconds, replicates in results:
+			save_result(directory, by_id[identifier], averages, seconds, replicates)
+			status.update(by_id[identifier])
+			if progress is not None:
+				progress(status)
+	finally:
+		if pool is not None:
+			pool.terminate()
+			pool.join()
+	return [job_id(config) for config in configs]
+
+#the averages stored for a finished job, as a dict of arrays named by result_names
+def load_result(directory, identifier):
+	with np.load(os.path.join(directory, 'results', identifier + '.npz')) as data:
+		return dict((name, data[name]) for name in result_names)
+
+#the configurations of the finished jobs of a sweep directory, by job id
+def sweep_journal(directory):
+	journal = {}
+	path = os.path.join(directory, 'journal.jsonl')
+	if os.path.exists(path):
+		with open(path) as f:
+			for line in f:
+				try:
+					entry = json.loads(line)
+				except ValueError:
+					continue
+				journal[entry['id']] = entry
+	return journal
+
+#SWEEPS TO RUN ON SHELL
+
+#run_sweep({'grid_size': [20, 40], 'rent_ceiling': [200000, 250000], 'distribution': ['random', 'CBD', 'BDquadrants'],
+#	   'create_rule': [us.random_create_rule, us.profit_probability_create_rule], 'steps': 200, 'batches': 50}, 'sweeps/rules')
+
+#run_sweep({'grid_size': [20, 40], 'distribution': ['random', 'CBD', 'BDquadrants'], 'steps': 200, 'batches': 8,
+#	   'targets': [[us.exposure_target(0.5), us.exposure_target(0.5, quintile = 4)]], 'max_batches': 200}, 'sweeps/adaptive')
@@ -0,0 +1,192 @@
+'''
+On-disk store of per-step UrbanScape grids, with memory-mapped reads of any step range
+'''
+
+import json
+import os
+import zlib
+
+import numpy as np
+from metrics import Observer
+
+# A trajectory is a directory with a meta.json, a times.bin of int64 step times and, per field,
+# either one raw file of frames appended step by step (read back through np.memmap, so any range
+# is a zero-copy view and runs larger than RAM stay readable) or, when compressed, one zlib file
+# per chunk of chunk_steps frames (only the chunks overlapping a requested range are decompressed).
+
+default_fields = ('income', 'ffcapture_number', 'externalities', 'agent_locations')
+
+def frame_bytes(field):
+	return int(np.prod(field['shape'])) * np.dtype(field['dtype']).itemsize
+
+#--------------
+# Recorder    |
+#--------------
+
+class TrajectoryRecorder(object):
+	# Appends the given grids of an urbanscape to the store in directory every `every` steps.
+	# With append = True an existing trajectory (e.g. of a run resumed from a checkpoint) is continued
+	# with the fields, interval and compression it was started with.
+	def __init__(self, directory, fields = default_fields, every = 1, compress = False, chunk_steps = 256, level = 1, append = False):
+		self.directory = directory
+		self.every = every
+		meta_path = os.path.join(directory, 'meta.json')
+		if os.path.exists(meta_path):
+			if not append:
+				raise ValueError('a trajectory is already stored in ' + directory)
+			reader = TrajectoryReader(directory)
+			self.meta = reader.meta
+			self.meta['steps'] = reader.steps
+			self.every = self.meta['every']
+			#frames written after the last readable step (a run that was killed) are dropped
+			self.truncate('times.bin', reader.steps * 8)
+			if not self.meta['compress']:
+				for name, field in reader.fields.items():
+					self.truncate(name + '.bin', reader.steps * frame_bytes(field))
+		else:
+			if not os.path.isdir(directory):
+				os.makedirs(directory)
+			self.meta = {'fields': dict((name, None) for name in fields), 'steps': 0, 'every': every,
+				     'compress': compress, 'chunk_steps': chunk_steps, 'level': level}
+		self.pending = dict((name, []) for name in self.meta['fields'])
+		self.pending_start = self.meta['steps']
+
+		#an appended compressed trajectory picks up its last partial chunk again
+		if self.meta['compress'] and self.meta['steps'] % self.meta['chunk_steps']:
+			self.pending_start -= self.meta['steps'] % self.meta['chunk_steps']
+			for name in self.pending:
+				frames = reader.chunk(name, self.pending_start // self.meta['chunk_steps'])
+				self.pending[name] = [frame.copy() for frame in frames]
+
+	def path(self, name):
+		return os.path.join(self.directory, name)
+
+	def truncate(self, name, size):
+		if os.path.exists(self.path(name)):
+			with open(self.path(name), 'r+b') as f:
+				f.truncate(size)
+
+	#records the urbanscape's grids if its time is due
+	def __call__(self, urbanscape):
+		if urbanscape.time % self.every == 0:
+			self.record(urbanscape)
+
+	def record(self, urbanscape):
+		for name, field in self.meta['fields'].items():
+			grid = np.ascontiguousarray(getattr(urbanscape, name))
+			if field is None:
+				field = self.meta['fields'][name] = {'dtype': grid.dtype.str, 'shape': list(grid.shape)}
+			if list(grid.shape) != field['shape']:
+				raise ValueError('%s changed shape from %s to %s' % (name, field['shape'], list(grid.shape)))
+			grid = grid.astype(field['dtype'], copy=False)
+			if self.meta['compress']:
+				self.pending[name].append(grid.copy())
+			else:
+				with open(self.path(name + '.bin'), 'ab') as f:
+					f.write(grid.tobytes())
+		with open(self.path('times.bin'), 'ab') as f:
+			f.write(np.int64(urbanscape.time).tobytes())
+		self.meta['steps'] += 1
+
+		if self.meta['compress'] and self.meta['steps'] - self.pending_start == self.meta['chunk_steps']:
+			self.flush()
+		elif self.meta['steps'] == 1:
+			self.write_meta()
+
+	def write_meta(self):
+		with open(self.path('meta.json.partial'), 'w') as f:
+			json.dump(self.meta, f)
+		os.rename(self.path('meta.json.partial'), self.path('meta.json'))
+
+	#writes the frames still held for the current chunk and the metadata.
+	#a partial chunk is rewritten whole when more frames of it are recorded later
+	def flush(self):
+		if self.meta['compress'] and self.meta['steps'] > self.pending_start:
+			chunk = self.pending_start // self.meta['chunk_steps']
+			for name, frames in self.pending.items():
+				data = zlib.compress(np.stack(frames).tobytes(), self.meta['level'])
+				with open(self.path('%s-%08d.z' % (name, chunk)), 'wb') as f:
+					f.write(data)
+			if self.meta['steps'] - self.pending_start == self.meta['chunk_steps']:
+				self.pending = dict((name, []) for name in self.meta['fields'])
+				self.pending_start = self.meta['steps']
+		self.write_meta()
+
+	close = flush
+
+	#an observer that records through metrics.observe, e.g. observers = [recorder.observer()]
+	def observer(self):
+		return Observer('trajectory', self.record, self.every)
+
+#--------------
+# Reader      |
+#--------------
+
+class TrajectoryReader(object):
+	def __init__(self, directory):
+		self.directory = directory
+		with open(os.path.join(directory, 'meta.json')) as f:
+			self.meta = json.load(f)
+		self.fields = dict((name, field) for name, field in self.meta['fields'].items() if field is not None)
+		self.compressed = self.meta['compress']
+		self.cache = (None, None, None)
+
+		#raw frames are counted from the file sizes, so a run that stopped without closing its recorder is still readable
+		if self.compressed:
+			steps = self.meta['steps']
+		else:
+			steps = min([os.path.getsize(self.path(name + '.bin')) // frame_bytes(field)
+				     for name, field in self.fields.items()] or [0])
+		times = np.fromfile(self.path('times.bin'), dtype=np.int64) if os.path.exists(self.path('times.bin')) else np.zeros(0, int)
+		self.steps = min(steps, len(times))
+		self.times = times[:self.steps]
+
+	def path(self, name):
+		return os.path.join(self.directory, name)
+
+	def __len__(self):
+		return self.steps
+
+	#index of the frame recorded at the given step time
+	def step_index(self, time):
+		index = np.searchsorted(self.times, time)
+		if index == self.steps or self.times[index] != time:
+			raise KeyError('no frame recorded at time %d' % time)
+		return int(index)
+
+	#frames start:stop of a field as a (steps, ...) array: a read-only memory-mapped view
+	#for raw trajectories, decompressed from the overlapping chunks otherwise
+	def read(self, name, start = 0, stop = None):
+		field = self.fields[name]
+		start, stop, _ = slice(start, stop).indices(self.steps)
+		stop = max(start, stop)
+		shape = tuple(field['shape'])
+		if not self.compressed:
+			frames = np.memmap(self.path(name + '.bin'), dtype=field['dtype'], mode='r', shape=(self.steps,) + shape)
+			return frames[start:stop]
+
+		chunk_steps = self.meta['chunk_steps']
+		out = np.empty((stop - start,) + shape, dtype=field['dtype'])
+		for chunk in range(start // chunk_steps, (stop - 1) // chunk_steps + 1 if stop > start else 0):
+			frames = self.chunk(name, chunk)
+			lo, hi = max(start, chunk * chunk_steps), min(stop, chunk * chunk_steps + len(frames))
+			out[lo - start:hi - start] = frames[lo - chunk * chunk_steps:hi - chunk * chunk_steps]
+		return out
+
+	#the decompressed frames of one chunk; the last chunk read is kept for sequential access
+	def chunk(self, name, chunk):
+		if self.cache[:2] != (name, chunk):
+			field = self.fields[name]
+			with open(self.path('%s-%08d.z' % (name, chunk)), 'rb') as f:
+				data = zlib.decompress(f.read())
+			frames = np.frombuffer(data, dtype=field['dtype']).reshape((-1,) + tuple(field['shape']))
+			self.cache = (name, chunk, frames)
+		return self.cache[2]
+
+	def __getitem__(self, name):
+		return self.read(name)
+
+	#the frame of a field recorded at the given step time
+	def at(self, name, time):
+		index = self.step_index(time)
+		return self.read(name, index, index + 1)[0]
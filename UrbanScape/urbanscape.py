@@ -1,6 +1,15 @@
+import itertools
+import math
+import multiprocessing
+import time
 import numpy as np
-import numpy.random as random
-import matplotlib.pyplot as pyplot
+import kernels
+from agenttable import AgentTable
+import randomstream
+import metrics
+import lod
+import accumulators
+from parameters import ModelParameters
 
 #Urbanscape v1.4
 
@@ -11,6 +20,10 @@ import matplotlib.pyplot as pyplot
 # added a GroceryStore Agent
 # added an attribute to the UrbanScape class for income spent on groceries
 
+#version of the model's behaviour, part of the key of stored results (see catalog).
+#bump it whenever a change alters what a seeded run produces
+model_version = '1.4'
+
 #-------------------------------------
 # Basic Classes: UrbanScape and Agent |
 #-------------------------------------
@@ -18,17 +31,32 @@ import matplotlib.pyplot as pyplot
 class UrbanScape(object):
 	# The urbanscape defines the context within which agents act
 	population_per_block = 20
+	dirty_tile = 32		#side of the square tiles used to track which parts of the grid changed
 
 	#size = size of the urban grid
 	#rent = yearly cost of commercial and residential space
-	def __init__(self, size, rent, create_rule=None, gradient = None, randomize = False):
+	#gradient = name of a rent distribution, a list of business district blocks [(i,j), ...],
+	#	or a dict of keyword arguments for district_distribution
+	#vectorized = use whole-grid array kernels instead of the per-block loops
+	#seed = int or tuple of ints seeding the urbanscape's random streams (see randomstream)
+	#parameters = the model constants (see parameters.ModelParameters), the defaults if None
+	def __init__(self, size, rent, create_rule=None, gradient = None, randomize = False, vectorized = True, seed = None, parameters = None):
 		blocks = np.ones((size,size))
 
 		self.create_rule = create_rule
+		self.parameters = parameters if parameters is not None else ModelParameters()
+		if self.parameters.lanes() is not None:
+			raise ValueError('per-lane model parameters need an ensemble.UrbanScapeEnsemble, not a single UrbanScape')
+		self.vectorized = vectorized
+		if seed is None:
+			seed = randomstream.fresh_seed()
+		self.seed = seed
+		self.random_state = randomstream.stream_state(seed, randomstream.GRID_STREAM)	#per-block draws
+		self.decisions = randomstream.RandomStream(randomstream.stream_state(seed, randomstream.DECISION_STREAM))	#create rule draws
 		self.size = size
-		self.agents = []
-		self.agent_locations = np.zeros((self.size,self.size))
-		self.agent_coords = {}
+		self.agents = AgentTable()	#live agents, one row per agent
+		self.occupancy = np.zeros((len(agent_types),size,size), dtype=int)	#count of agents of each type code on each block
+		self.occupancy_version = 0	#bumped whenever an agent is added or removed
 		self.time = 0
 		self.rent_ceiling = rent
 		self.rent_floor = 5000
@@ -44,6 +72,10 @@ class UrbanScape(object):
 			self.businessdistricts_quadrant_distribution()
 		elif gradient == 'CBD':
 			self.centralbusinessdistrict_distribution()
+		elif isinstance(gradient, dict):
+			self.district_distribution(**gradient)
+		elif isinstance(gradient, (list, tuple)):
+			self.district_distribution(gradient)
 					
 		self.income = np.ones_like(blocks) * self.rent * 4
 		
@@ -51,19 +83,73 @@ class UrbanScape(object):
 			self.randomize_distribution()
 		
 		self.externalities = np.zeros_like(blocks)		#total count of (negative) externality effect
-		self.ffcapture_number = np.zeros_like(blocks)	#count of FastFoodAgent effect in UrbanScape
-		self.gscapture_number = np.zeros_like(blocks)   #count of GroceryStoreAgent effect in UrbanScape
+		for agent_type in agent_types:	#count of each agent type's effect in UrbanScape, e.g. ffcapture_number
+			setattr(self, agent_type.capture_field, np.zeros_like(blocks))
 		self.mobility = np.ones_like(blocks)			#a measure of disability
 		self.food_away = np.ones_like(blocks)			#distribution of food-related expenditures per block
 		self.fast_food = np.ones_like(blocks)
 		self.grocery = np.ones_like(blocks)
+		self.net_capture = np.zeros_like(blocks)		#work buffers for the in-place externality update
+		self.heal_buffer = np.zeros_like(blocks)
+		self.heal_mask = np.zeros((size,size), dtype=bool)
+		self.food_away_base = np.ones_like(blocks)		#expenditures before the random multipliers
+		self.fast_food_base = np.ones_like(blocks)
+		self.grocery_base = np.ones_like(blocks)
+
+		#change tracking for vectorized runs: agent births and deaths waiting to be applied to the
+		#capture numbers, and the tiles where ff - gs capture or externalities are nonzero.
+		#only those tiles can change externalities, mobility and income from one step to the next.
+		#vectorized runs match the loop mode to rounding, not bit for bit: the summed-area revenue
+		#lookups round differently from the per-block sums (agent wealth drifts by ~1e-7 over 60 steps)
+		ntiles = kernels.tile_count(size, self.dirty_tile)
+		self.pending_captures = []	#(type code, x, y, +1 or -1)
+		self.rebuild_captures = True
+		self.net_tiles = np.zeros((ntiles,ntiles), dtype=bool)
+		self.externality_tiles = np.zeros((ntiles,ntiles), dtype=bool)
+		self.dirty_regions = [np.s_[...]]	#regions of the grid whose income changed in the current step
+		self.all_dirty = True
 		self.update_expenditures()
+		self.update_revenue_tables()
 	
+	#copies a new agent into the agent table; the table holds its state from then on
 	def add_agent(self, agent):
-		self.agents.append(agent)
+		if agent.code >= len(self.occupancy):
+			extra = np.zeros((agent.code + 1 - len(self.occupancy),self.size,self.size), dtype=int)
+			self.occupancy = np.concatenate((self.occupancy, extra))
+			self.rebuild_captures = True
+		agent.id = self.agents.append(agent.code, agent.loc, agent.wealth, agent.operating_costs, self.time)
+		self.occupancy[(agent.code,) + tuple(agent.loc)] += 1
+		self.occupancy_version += 1
+		x,y = agent.loc
+		self.pending_captures.append((agent.code, x, y, 1))
 		
 	def remove_agent(self, agent):
-		self.agents.remove(agent)
+		self.remove_agents(self.agents['id'] == agent.id)
+
+	#removes the agents in the table rows where dead is True, keeping the occupancy counts in step
+	def remove_agents(self, dead):
+		agents = self.agents
+		if not dead.any():
+			return
+		np.subtract.at(self.occupancy, self.occupancy_index(dead), 1)
+		self.pending_captures.extend((kind, x, y, -1) for kind,x,y in zip(agents['kind'][dead], agents['x'][dead], agents['y'][dead]))
+		agents.compact(~dead)
+		self.occupancy_version += 1
+
+	#index of the agents in the given table rows into the occupancy array
+	def occupancy_index(self, rows):
+		agents = self.agents
+		return agents['kind'][rows], agents['x'][rows], agents['y'][rows]
+
+	#the lanes of the agents in the given table rows, for urbanscapes that stack several replicates
+	def agent_lanes(self, rows):
+		return None
+
+	#count of agents of one type code on each block, read from the incrementally maintained occupancy
+	def type_occupancy(self, code):
+		if code < len(self.occupancy):
+			return self.occupancy[code]
+		return np.zeros(self.rent.shape, dtype=int)
 	
 	# defines effect radius within particular radius and location
 	def effect_radius(self, loc, radius):
@@ -75,88 +161,164 @@ class UrbanScape(object):
 				effect_coordinates.append((i,j))
 		return effect_coordinates
 	
-	# defines the $ amount spent on fast food and groceries in blocks of given coordinates
-	def capture_expenditures(self, coords):
-		coords = coords
-		ffexposure_total = 0
-		gsexposure_total = 0
-		
-		for k in range(len(coords)):
-			x,y = coords[k]
-			
-			if 0 <= x <= (self.size-1) and 0 <= y <= (self.size-1):
-				ffexposure = (self.fast_food[x,y] / (self.ffcapture_number[x,y] + 1e-10)) * self.population_per_block
-				ffexposure_total += ffexposure
-				
-				gsexposure = (self.grocery[x,y] / (self.gscapture_number[x,y] + 1e-10)) * self.population_per_block
-				gsexposure_total += gsexposure
-			
-		return ffexposure_total, gsexposure_total
+	#the $ amount of an agent type's spend field captured within radius of loc.
+	#in vectorized mode this is an O(1) lookup in the integral image built by update_revenue_tables
+	def capture_type_expenditures(self, agent_type, loc, radius):
+		x,y = loc
+		if self.vectorized:
+			return kernels.window_lookup(self.revenue_tables[agent_type.code], x, y, radius)
+
+		spend = getattr(self, agent_type.spend_field)
+		capture_number = getattr(self, agent_type.capture_field)
+		total = 0
+		for i,j in self.effect_radius(loc, radius):
+			if 0 <= i <= (self.size-1) and 0 <= j <= (self.size-1):
+				total += (spend[i,j] / (capture_number[i,j] + 1e-10)) * self.population_per_block
+		return total
+
+	#per-block share of expenditures captured by each agent covering the block, and its integral image,
+	#for every agent type. blocks that no agent covers contribute nothing (rather than dividing by
+	#the 1e-10 guard), which keeps the cumulative sums well conditioned on large grids
+	def update_revenue_tables(self):
+		self.revenue_tables = {}
+		for agent_type in agent_types:
+			spend = getattr(self, agent_type.spend_field)
+			capture_number = getattr(self, agent_type.capture_field)
+			covered = capture_number > 0
+			share = np.zeros(spend.shape)
+			share[covered] = (spend[covered] / (capture_number[covered] + 1e-10)) * self.population_per_block
+			self.revenue_tables[agent_type.code] = kernels.summed_area_table(share)
+
+	#agent locations are specified as -1 if FastFoodAgent, 1 if GroceryStoreAgent, and -0.5 if block has both
+	#these values correspond to red, green, and orange on the 'RdYlGn' colormap on matplotlib.pyplot.
+	#the grid is only needed for plotting, so it is derived from the occupancy counts when it is read
+	@property
+	def agent_locations(self):
+		if getattr(self, 'agent_locations_version', None) != self.occupancy_version:
+			self.update_agent_locations()
+		return self.agent_locations_grid
 
 	def update_agent_locations(self):
-		#agent locations are specified as -1 if FastFoodAgent, 1 if GroceryStoreAgent, and -0.5 if block has both
-		#these values correspond to red, green, and orange on the 'RdYlGn' colormap on matplotlib.pyplot
-		self.agent_locations = np.zeros((self.size,self.size))
-		self.agent_coords = {}
-		for aa in self.agents:
-			self.agent_coords[aa] = aa.loc     #keeps track of type coord and type of agent
-			
-		#this finds redundant and single-occurring coordinates.
-		#redundant coordinates are assumed to contain both FastFoodAgents and GroceryStoreAgents
-		coords = self.agent_coords.values()
-		set_coords = sorted(set(coords))
-		
-		for i in set_coords:
-			coords.remove(i)
-		redundant_locs = coords
-		
-		for i in redundant_locs:
-			try:
-				set_coords.remove(i)
-			except:
-				pass
-		single_locs = set_coords
-		
-		for agent, loc in self.agent_coords.items():
-			string = str(agent)
-			x,y = loc
-
-			if loc in redundant_locs:
-				self.agent_locations[x,y] = -0.5
+		#blocks holding more than one agent are assumed to contain both FastFoodAgents and GroceryStoreAgents
+		total = self.occupancy.sum(axis=0)
 
-			if loc in single_locs:
-				if 'FastFoodAgent' in string:
-					self.agent_locations[x,y] = -1
+		locations = np.zeros(self.rent.shape)
+		for agent_type in agent_types:
+			single = (total == 1) & (self.type_occupancy(agent_type.code) == 1)
+			locations[single] = agent_type.location_code
+		locations[total > 1] = -0.5
 
-				if 'GroceryStoreAgent' in string:
-					self.agent_locations[x,y] = 1
+		self.agent_locations_grid = locations
+		self.agent_locations_version = self.occupancy_version
 
 	def update_income(self):
-		self.income = (self.rent * 4) * self.mobility
+		if self.vectorized:
+			for region in self.dirty_regions:
+				np.multiply(self.rent[region], 4, out=self.income[region])
+				self.income[region] *= self.mobility[region]
+		else:
+			self.income = (self.rent * 4) * self.mobility
 	
 	def update_capture_number(self):
-		self.ffcapture_number = np.zeros((self.size,self.size))
-		self.gscapture_number = np.zeros((self.size,self.size))
-		for agent in self.agents:
-			string = str(agent)
-
-			if 'FastFoodAgent' in string:
-				for coords in agent.effect_coordinates:
-					x,y = coords
-					if 0 <= x <= (self.size-1) and 0<= y <= (self.size-1):
-						self.ffcapture_number[x,y] += 1
-
-			if 'GroceryStoreAgent' in string:
-				for coords in agent.effect_coordinates:
-					x,y = coords
-					if 0 <= x <= (self.size-1) and 0<= y <= (self.size-1):
-						self.gscapture_number[x,y] += 1
+		if not self.vectorized:
+			self.loop_capture_number()
+			return
+
+		#applying the births and deaths window by window is cheaper than refiltering the
+		#whole grid unless a large part of the grid changed
+		area = sum((2 * self.parameters.agent(agent_types[code], 'radius') + 1)**2 for code,x,y,delta in self.pending_captures)
+		if self.rebuild_captures or area > self.size**2:
+			self.filter_capture_number()
+			self.net_tiles = kernels.tile_any(self.ffcapture_number != self.gscapture_number, self.dirty_tile)
+			self.rebuild_captures = False
+		else:
+			self.incremental_capture_number()
+		self.pending_captures = []
+
+	#adds (or removes) each born (or dead) agent to the capture numbers of the blocks in its effect radius,
+	#and refreshes the nonzero ff - gs flags of the tiles those windows touch
+	def incremental_capture_number(self):
+		touched = set()
+		for code, x, y, delta in self.pending_captures:
+			agent_type = agent_types[code]
+			r = self.parameters.agent(agent_type, 'radius')
+			x0, x1 = max(x - r, 0), min(x + r + 1, self.size)
+			y0, y1 = max(y - r, 0), min(y + r + 1, self.size)
+			getattr(self, agent_type.capture_field)[x0:x1,y0:y1] += delta
+			touched.update((ti,tj) for ti in kernels.tile_span(x0, x1, self.dirty_tile)
+					for tj in kernels.tile_span(y0, y1, self.dirty_tile))
+
+		for ti,tj in touched:
+			region = kernels.tile_region(ti, tj, self.dirty_tile)
+			self.net_tiles[ti,tj] = (self.ffcapture_number[region] != self.gscapture_number[region]).any()
+
+	#counts the agents whose effect radius covers each block with a box filter over the per-type occupancy grids.
+	#the cost is O(size**2) however many agents there are
+	def filter_capture_number(self):
+		for agent_type in agent_types:
+			radius = self.parameters.agent(agent_type, 'radius', ndim=1)
+			capture_number = kernels.lane_window_sum(self.type_occupancy(agent_type.code), radius)
+			setattr(self, agent_type.capture_field, capture_number)
+
+	def loop_capture_number(self):
+		capture_numbers = [np.zeros((self.size,self.size)) for agent_type in agent_types]
+		for x, y, kind in zip(self.agents['x'], self.agents['y'], self.agents['kind']):
+			for coords in self.effect_radius((x,y), self.parameters.agent(agent_types[kind], 'radius')):
+				i,j = coords
+				if 0 <= i <= (self.size-1) and 0<= j <= (self.size-1):
+					capture_numbers[kind][i,j] += 1
+
+		for agent_type in agent_types:
+			setattr(self, agent_type.capture_field, capture_numbers[agent_type.code])
 
 	def update_externalities(self):
+		if self.vectorized:
+			self.dirty_regions = self.active_regions()
+			for region in self.dirty_regions:
+				self.inplace_externalities(region)
+			if self.all_dirty:
+				self.externality_tiles = kernels.tile_any(self.externalities != 0, self.dirty_tile)
+				self.all_dirty = False
+			else:
+				for ti,tj in zip(*np.nonzero(self.net_tiles | self.externality_tiles)):
+					region = kernels.tile_region(ti, tj, self.dirty_tile)
+					self.externality_tiles[ti,tj] = self.externalities[region].any()
+		else:
+			self.loop_externalities()
+
+	#regions that externalities, mobility and income have to be recomputed over this step.
+	#a block with zero externalities and zero ff - gs capture stays at zero, so only tiles with either
+	#nonzero can change. falls back to the whole grid on the first step or when most tiles are active
+	def active_regions(self):
+		active = self.net_tiles | self.externality_tiles
+		if self.all_dirty or active.mean() > 0.5:
+			return [np.s_[...]]
+		return [kernels.tile_region(ti, tj, self.dirty_tile) for ti,tj in zip(*np.nonzero(active))]
+
+	#single pass version of loop_externalities working in place on the preallocated arrays.
+	#clamps at zero, then heals (truncating toward zero) only where ff - gs capture is zero
+	def inplace_externalities(self, region = np.s_[...]):
+		heal_rate = self.parameters.get('heal_rate')
+
+		externalities = self.externalities[region]
+		net_capture = self.net_capture[region]
+		heal_buffer = self.heal_buffer[region]
+		heal_mask = self.heal_mask[region]
+
+		np.subtract(self.ffcapture_number[region], self.gscapture_number[region], out=net_capture)
+		externalities += net_capture
+		np.maximum(externalities, 0, out=externalities)
+
+		np.equal(net_capture, 0, out=heal_mask)
+		np.multiply(externalities, heal_rate, out=heal_buffer)
+		np.trunc(heal_buffer, out=heal_buffer)
+		np.copyto(externalities, heal_buffer, where=heal_mask)
+
+	def loop_externalities(self):
 		#externalities here are 'negative externalities':
 		#ffscapture_number adds to externalities, and gscapture_number substracts from it.
 		#diminishes externalities by heal_rate if capture_number = 0
-		heal_rate = float(0.95)
+		heal_rate = float(self.parameters.heal_rate)
 
 		for i in range(self.size):
 			for j in range(self.size):
@@ -169,12 +331,35 @@ class UrbanScape(object):
 					self.externalities[i,j] = int(self.externalities[i,j] * heal_rate)
 		
 	def update_mobility(self):
+		if self.vectorized:
+			for region in self.dirty_regions:
+				self.inplace_mobility(region)
+		else:
+			self.loop_mobility()
+
+	#the logistic decay of loop_mobility as one in-place pass over the mobility array.
+	#b3**(E - c3) overflows to inf for very large externalities, which gives the limit a3
+	def inplace_mobility(self, region = np.s_[...]):
+		p = self.parameters
+		a3 = p.get('a3')
+		b3 = p.get('b3')
+		c3 = p.get('c3')
+
+		M = self.mobility[region]
+		np.subtract(self.externalities[region], c3, out=M)
+		with np.errstate(over='ignore'):
+			np.power(b3, M, out=M)
+		M += 1
+		np.divide(1 - a3, M, out=M)
+		M += a3
+
+	def loop_mobility(self):
 		#a logistic decay function
 		#decreases mobility to limit of 'a3' as externality count approaches infinity
-		
-		a3 = float(0.75)
-		b3 = float(1.5)
-		c3 = float(50)
+		p = self.parameters
+		a3 = float(p.a3)
+		b3 = float(p.b3)
+		c3 = float(p.c3)
 		
 		for i in range(self.size):
 			for j in range(self.size):
@@ -183,10 +368,71 @@ class UrbanScape(object):
 				self.mobility[i,j] = M	
 		
 	def update_expenditures(self):
+		if self.vectorized:
+			self.vectorized_expenditures()
+		else:
+			self.loop_expenditures()
+
+	#whole-grid version of loop_expenditures: one bulk random draw per field and five multiplies over the grid.
+	#the income curves (ufunc power and clip) are cached and only recomputed in the regions whose income changed.
+	#the multipliers are drawn in the same order as the loops, so for a given seed both give the same results
+	#up to rounding (ufunc power rounds differently from ** on scalars); don't rely on exact equality
+	def vectorized_expenditures(self):
+		for region in self.dirty_regions:
+			self.expenditure_bases(region)
+
+		#Expenditures on 'Food Away From Home'
+		np.multiply(self.food_away_base, self.random_float_array(0.75,1.25), out=self.food_away)
+
+		#Expenditures on 'Fast Food Restaurants'
+		np.multiply(self.fast_food_base, self.food_away, out=self.fast_food)
+		self.fast_food *= self.random_float_array(0.75,1.25)
+
+		#Expenditures on 'Food At Home', which as assumed to be all grocery expenditures
+		np.multiply(self.grocery_base, self.random_float_array(0.75,1.25), out=self.grocery)
+
+	#expenditure curves of loop_expenditures before the random multipliers, over one region of the grid
+	def expenditure_bases(self, region = np.s_[...]):
+		income = self.income[region]
+		p = self.parameters
+
+		#Expenditures on 'Food Away From Home'
+		a1 = p.get('fafh_a1')
+		b1 = p.get('fafh_b1')
+
+		food_away = self.food_away_base[region]
+		np.power(income, b1, out=food_away)
+		food_away *= a1
+		food_away *= income
+
+		#Expenditures on 'Fast Food Restaurants'
+		a2 = p.get('ffr_a2')
+		b2 = p.get('ffr_b2')
+		c2 = p.get('ffr_c2')
+
+		fast_food = self.fast_food_base[region]
+		np.multiply(income, a2, out=fast_food)
+		fast_food += b2
+		np.square(fast_food, out=fast_food)
+		np.subtract(c2, fast_food, out=fast_food)
+		np.maximum(fast_food, 0.075, out=fast_food)
+
+		#Expenditures on 'Food At Home', which as assumed to be all grocery expenditures
+		a1 = p.get('fah_a1')
+		b1 = p.get('fah_b1')
+
+		grocery = self.grocery_base[region]
+		np.power(income, b1, out=grocery)
+		grocery *= a1
+		grocery *= income
+
+	def loop_expenditures(self):
+		p = self.parameters
+
 		#Expenditures on 'Food Away From Home'
 		#Defining constants a1, b1
-		a1 = 1.5802
-		b1 = -0.32
+		a1 = p.fafh_a1
+		b1 = p.fafh_b1
 
 		for i in range(self.size):
 			for j in range(self.size):
@@ -196,9 +442,9 @@ class UrbanScape(object):
 				
 		#Expenditures on 'Fast Food Restaurants'
 		#Defining constants a2, b2, c2
-		a2 = 5.528e-6
-		b2 = -0.332
-		c2 = 0.40
+		a2 = p.ffr_a2
+		b2 = p.ffr_b2
+		c2 = p.ffr_c2
 		
 		for i in range(self.size):
 			for j in range(self.size):
@@ -209,8 +455,8 @@ class UrbanScape(object):
 				self.fast_food[i,j] = FF * self.food_away[i,j] * rand_multiplier
 				
 		#Expenditures on 'Food At Home', which as assumed to be all grocery expenditures
-		a1 = 73.969
-		b1 = -0.632
+		a1 = p.fah_a1
+		b1 = p.fah_b1
 		
 		for i in range(self.size):
 			for j in range(self.size):
@@ -247,115 +493,122 @@ class UrbanScape(object):
 			self.rent[:,j] = self.rent[:,j] * gg
 			
 	def random_distribution(self):
-		dist = np.random.randint(self.rent_floor, self.rent_ceiling,(self.size,self.size))
+		dist = self.random_state.randint(self.rent_floor, self.rent_ceiling,(self.size,self.size))
 		self.rent = dist
         
-        #calculates the rent based on distance from the business district block
-        def distance_rent_function(self,quadrant_coords,bd_coords):
-                q = quadrant_coords
-                bd = bd_coords
-                x_dist = float(q[0] - bd[0])
-                y_dist = float(q[1] - bd[1])
-                dist = np.sqrt(x_dist**2 + y_dist**2)
-                return dist      
-        
-        def exponential_rent_function(self,distance,coord):
-                i,j = coord
-                Lambda = np.log(float(self.rent_floor)/float(self.rent_ceiling)) * (-1/self.dmax)
-                rent_value = self.rent_ceiling * np.e**(-Lambda*distance)
-                self.rent[i][j] = rent_value
-                
-        def linear_rent_function(self,distance,coord):
-                i,j = coord
-                Alpha = (float(self.rent_floor)-float(self.rent_ceiling))/self.dmax
-                rent_value = self.rent_ceiling + (Alpha * distance)
-                self.rent[i][j] = rent_value
-        
-        #the approximate center of each quadrant of the urbanscape is a 'business district'
-        #the assumption being that rent and income decreases as one moves further away
-        def businessdistricts_quadrant_distribution(self):
-                district1 = [(i,j) 
-                    for i in range(int(np.ceil(float(self.size)*0.5)))
-                    for j in range(int(np.ceil(float(self.size)*0.5)))]
-                district2 = [(i,j) 
-                    for i in range(int(np.ceil(float(self.size)*0.5)),self.size)
-                    for j in range(int(np.ceil(float(self.size)*0.5)))]
-                district3 = [(i,j) 
-                    for i in range(int(np.ceil(float(self.size)*0.5)))
-                    for j in range(int(np.ceil(float(self.size)*0.5)),self.size)]
-                district4 = [(i,j) 
-                    for i in range(int(np.ceil(float(self.size)*0.5)),self.size)
-                    for j in range(int(np.ceil(float(self.size)*0.5)),self.size)]
-            
-                d1_coords = (np.ceil(float(self.size) * 0.25), np.ceil(float(self.size)* 0.25))
-                d2_coords = (np.ceil(float(self.size) * 0.75), np.ceil(float(self.size)* 0.25))
-                d3_coords = (np.ceil(float(self.size) * 0.25), np.ceil(float(self.size)* 0.75))
-                d4_coords = (np.ceil(float(self.size) * 0.75), np.ceil(float(self.size)* 0.75))
-        
-                d1_distances = [self.distance_rent_function(q,d1_coords) for q in district1]
-                d2_distances = [self.distance_rent_function(q,d2_coords) for q in district2]
-                d3_distances = [self.distance_rent_function(q,d3_coords) for q in district3]
-                d4_distances = [self.distance_rent_function(q,d4_coords) for q in district4]
-                
-                self.dmax = max(d1_distances)
-                
-                for i in range(len(district1)):
-                    self.exponential_rent_function(d1_distances[i], district1[i])
-                    self.exponential_rent_function(d2_distances[i], district2[i])
-                    self.exponential_rent_function(d3_distances[i], district3[i])
-                    self.exponential_rent_function(d4_distances[i], district4[i])
-        
-        def centralbusinessdistrict_distribution(self):
-                block_coords = [(i,j)
-                    for i in range(self.size)
-                    for j in range(self.size)]
-                district_coords = (np.ceil(float(self.size) *0.5), np.ceil(float(self.size)*0.5))
-                block_distances = [self.distance_rent_function(q,district_coords) for q in block_coords]
-                self.dmax = max(block_distances)
-                
-                for i in range(len(block_coords)):
-                    #self.linear_rent_function(block_distances[i], block_coords[i])
-                    self.exponential_rent_function(block_distances[i],block_coords[i])
-        
-        #a function that randomizes the rent and income values (independently) within an error of 20%
-        def randomize_distribution(self):
-                for i in range(self.size):
-                    for j in range(self.size):
-                        randfloat = self.random_float_range(0.75,1.25)
-                        
-                        if self.rent[i][j] * randfloat > self.rent_ceiling:
-                            pass
-                        else:
-                            self.rent[i][j] *= randfloat
-                
-                for i in range(self.size):
-                    for j in range(self.size):
-                        randfloat = self.random_float_range(0.75,1.25)
-                        
-                        if self.income[i][j] * randfloat > (self.rent_ceiling * 4):
-                            pass
-                        else:
-                            self.income[i][j] *= randfloat
-                
+	#rent of blocks at the given distances (an array) from a business district block, falling from the
+	#rent ceiling at the district to the rent floor at distance self.dmax
+	def exponential_rent_function(self, distance):
+		Lambda = np.log(float(self.rent_floor)/float(self.rent_ceiling)) * (-1/self.dmax)
+		rent = np.multiply(-Lambda, distance)
+		np.power(np.e, rent, out=rent)
+		rent *= self.rent_ceiling
+		return rent
+
+	def linear_rent_function(self, distance):
+		Alpha = (float(self.rent_floor)-float(self.rent_ceiling))/self.dmax
+		rent = np.multiply(Alpha, distance)
+		rent += self.rent_ceiling
+		return rent
+
+	#rent set by distance from any number of business district blocks, centres = [(i,j), ...].
+	#combine = 'nearest' prices each block by its distance to the closest district; 'weighted' adds
+	#up the rent profile of every district, times weights[k], and scales the sum so the top block
+	#pays the rent ceiling. profile is 'exponential' or 'linear'; dmax, the distance at which a
+	#district's profile reaches the rent floor, defaults to the largest distance of any block to
+	#its nearest district
+	def district_distribution(self, centres, combine = 'nearest', profile = 'exponential', weights = None, dmax = None):
+		rent_function = {'exponential': self.exponential_rent_function,
+				 'linear': self.linear_rent_function}[profile]
+		shape = self.rent.shape
+		distance = kernels.distance_field(shape, centres)
+		self.dmax = float(distance.max()) if dmax is None else dmax
+
+		if combine == 'nearest':
+			self.rent = rent_function(distance)
+		elif combine == 'weighted':
+			if weights is None:
+				weights = np.ones(len(centres))
+			total = np.zeros(shape)
+			for centre, weight in zip(centres, weights):
+				total += weight * rent_function(kernels.centre_distance(shape, centre))
+			self.rent = np.maximum(total * (self.rent_ceiling / total.max()), self.rent_floor)
+		else:
+			raise ValueError('unknown district combination ' + repr(combine))
+
+	#the approximate center of each quadrant of the urbanscape is a 'business district'
+	#the assumption being that rent and income decreases as one moves further away.
+	#each block is priced by its distance to the district of its own quadrant, whose
+	#row and column are picked by the half of the grid the block's row and column fall in
+	def businessdistricts_quadrant_distribution(self):
+		half = int(np.ceil(float(self.size)*0.5))
+		quarter, three_quarters = np.ceil(float(self.size) * 0.25), np.ceil(float(self.size) * 0.75)
+		district = np.where(np.arange(self.size) < half, quarter, three_quarters)
+		dmax = kernels.centre_distance((half,half), (quarter,quarter)).max()
+		self.district_distribution([(district, district)], dmax = dmax)
+
+	def centralbusinessdistrict_distribution(self):
+		district_coords = (np.ceil(float(self.size) *0.5), np.ceil(float(self.size)*0.5))
+		self.district_distribution([district_coords])
+		#self.district_distribution([district_coords], profile = 'linear')
+
+	#a function that randomizes the rent and income values (independently) within an error of 20%,
+	#leaving the blocks that would go over the rent (or income) ceiling as they are
+	def randomize_distribution(self):
+		randfloats = self.random_float_array(0.75,1.25)
+		rent = self.rent * randfloats
+		np.copyto(self.rent, rent, casting='unsafe', where=~(rent > self.rent_ceiling))
+
+		randfloats = self.random_float_array(0.75,1.25)
+		income = self.income * randfloats
+		np.copyto(self.income, income, casting='unsafe', where=~(income > (self.rent_ceiling * 4)))
+		
         #a function that generates a random float between a specified range
         def random_float_range(self, low, high):
-                randfloat = np.random.random() * (high - low) + low
+                randfloat = self.random_state.random_sample() * (high - low) + low
                 return randfloat
+
+        #an array of random floats in a specified range, one per block of the urbanscape
+        def random_float_array(self, low, high):
+                randfloats = self.random_state.random_sample(self.rent.shape) * (high - low) + low
+                return randfloats
         
+	#every agent gathers its revenues for the year and pays its operating costs,
+	#then the agents that went broke are removed from the table in one pass
+	def agents_step(self):
+		agents = self.agents
+		for agent_type in agent_types:
+			rows = agents.of_kind(agent_type.code)
+			if not rows.any():
+				continue
+			radius = self.parameters.agent(agent_type, 'radius', ndim=1)
+			if self.vectorized:
+				lanes = self.agent_lanes(rows)
+				if lanes is not None and isinstance(radius, np.ndarray):
+					radius = radius[lanes]
+				table = self.revenue_tables[agent_type.code]
+				revenue = kernels.window_lookup(table, agents['x'][rows], agents['y'][rows], radius, lanes)
+			else:
+				revenue = [self.capture_type_expenditures(agent_type, (x,y), radius)
+					   for x,y in zip(agents['x'][rows], agents['y'][rows])]
+			agents['wealth'][rows] += np.asarray(revenue) - agents['operating_costs'][rows]
+
+		#Remove the agents that are broke
+		self.remove_agents(agents['wealth'] < 0)
+
 	def step(self):
 		self.create_rule(self)
 
 		#Update externality-related attributes
-		self.update_agent_locations()
 		self.update_capture_number()
 		self.update_externalities()
 		self.update_mobility()
 		self.update_income()
 		self.update_expenditures()
+		self.update_revenue_tables()
 		
 		#Agent actions
-		for agent in self.agents:
-			agent.step(self)
+		self.agents_step()
 		
 		#Time step
 		self.time += 1
@@ -364,80 +617,66 @@ class UrbanScape(object):
 # Base class for all Food Agents |
 #---------------------------------
 
+# A food agent describes a new store: its type and starting state.
+# Once added to an urbanscape its state lives in the urbanscape's agent table.
 class Agent(object):
-    def __init__(self, loc, wealth):
+	def __init__(self, loc, wealth):
 		self.loc = loc		# x,y coordinates of location in urbanscape
 		self.wealth = wealth	# $ amount
+		self.operating_costs = 0
 
-	# Called every time-step
-    def step(self, urbanscape):
-		self.check_bankruptcy(urbanscape)
-		
-	# Remove the agent if broke
-    def check_bankruptcy(self, urbanscape):
-		if self.wealth < 0:
-			self.wealth = 0
-			urbanscape.remove_agent(self)
+#------------------------
+# Food Agent Registry   |
+#------------------------
+
+# Every type of food provider is registered here with an integer type code,
+# which is what the agent table and the update methods dispatch on.
+# A registered class defines:
+#   label - short name used by the create rules, e.g. 'FF'
+#   operations, initial_wealth, radius - defaults of its economics and effect radius,
+#	which an urbanscape reads from its ModelParameters (e.g. FF_operations)
+#   spend_field - the UrbanScape expenditure array it captures revenue from
+#   capture_field - the UrbanScape array counting its effect radii on each block
+#   location_code - its value in agent_locations on a block it occupies alone
+agent_types = []
+
+def register_agent_type(agent_class):
+	agent_class.code = len(agent_types)
+	agent_types.append(agent_class)
+	return agent_class
+
+#looks up a registered agent type by its label
+def agent_type_for(label):
+	for agent_type in agent_types:
+		if agent_type.label == label:
+			return agent_type
+	raise ValueError('no food agent type registered with label ' + repr(label))
+
+class FoodAgent(Agent):
+	def __init__(self, loc, urbanscape):
+		parameters = urbanscape.parameters
+		super(FoodAgent, self).__init__(loc, parameters.agent(type(self), 'initial_wealth'))
+		self.operating_costs = (urbanscape.rent[loc]) + (parameters.agent(type(self), 'operations'))
 
-class FastFoodAgent(Agent):
+@register_agent_type
+class FastFoodAgent(FoodAgent):
+	label = 'FF'
 	operations = 50000	# $ per year
 	initial_wealth = 10000	# $ amount
 	radius = 2	# number of block effected around location
-	effect_coordinates = []
-
-	def __init__(self, loc, urbanscape):
-		super(FastFoodAgent, self).__init__(loc, self.initial_wealth)
-		self.define_radius(urbanscape)
-		self.operating_costs = (urbanscape.rent[loc]) + (FastFoodAgent.operations)
-	def step(self, urbanscape):
-		# 1. Gather revenues for the year
-		self.capture_revenue(urbanscape)
-		
-		# 2. Perform parent class step function
-		super(FastFoodAgent, self).step(urbanscape)
-	
-	#this function defines how much of fast food expenditures are
-	#captured by the FoodAgent. If there are no competing FastFoodAgents,
-	#assumes that FoodAgent captures all of block expenditures.
-	
-	def define_radius(self, urbanscape):
-		self.effect_coordinates = urbanscape.effect_radius(self.loc, self.radius)
-	
-	def capture_revenue(self, urbanscape):
-		x,y = self.loc
-		self.wealth += (urbanscape.capture_expenditures(self.effect_coordinates)[0]) - self.operating_costs
-		#capture_expenditures returns a list of two values, the 0th index being the ff_revenues
+	spend_field = 'fast_food'
+	capture_field = 'ffcapture_number'
+	location_code = -1
 
-class GroceryStoreAgent(Agent):
+@register_agent_type
+class GroceryStoreAgent(FoodAgent):
+	label = 'GS'
 	operations = 200000	# $ per year
 	initial_wealth = 25000	# $ amount
 	radius = 2	# number of block effected around location
-	effect_coordinates = []
-
-	def __init__(self, loc, urbanscape):
-		super(GroceryStoreAgent, self).__init__(loc, self.initial_wealth)
-		self.define_radius(urbanscape)
-		self.operating_costs = (urbanscape.rent[loc]) + (GroceryStoreAgent.operations)
-	def step(self, urbanscape):
-		# 1. Gather revenues for the year
-		self.capture_revenue(urbanscape)
-		
-		# 2. Perform parent class step function
-		super(GroceryStoreAgent, self).step(urbanscape)
-	
-	#this function defines how much of grocery store expenditures are
-	#captured by the FoodAgent. If there are no competing FoodAgents,
-	#assumes that FoodAgent captures all of block expenditures.
-	
-	def define_radius(self, urbanscape):
-		self.effect_coordinates = urbanscape.effect_radius(self.loc, self.radius)
-	
-	#assumes that the rest of income spent on food away from home is spent on groceries
-	def capture_revenue(self, urbanscape):
-		x,y = self.loc
-		self.wealth += (urbanscape.capture_expenditures(self.effect_coordinates)[1]) - self.operating_costs
-		#capture_expenditures returns a list of two values, the 1st index being the ff_revenues
-						
+	spend_field = 'grocery'
+	capture_field = 'gscapture_number'
+	location_code = 1
 									
 #------------------------
 # Create Rule Functions |
@@ -448,11 +687,11 @@ def no_create_rule(urbanscape):
 
 #creates FastFoodAgents randomly on the grid
 def random_create_rule(urbanscape):
-	x = random.randint(0,urbanscape.size)
-	y = random.randint(0,urbanscape.size)
+	x = urbanscape.decisions.randint(0,urbanscape.size)
+	y = urbanscape.decisions.randint(0,urbanscape.size)
 
 	if urbanscape.time % 5 == 0:
-		agent_type_decision = random.rand()
+		agent_type_decision = urbanscape.decisions.rand()
 		if agent_type_decision < 0.5:
 			urbanscape.add_agent(FastFoodAgent((x,y),urbanscape))
 		else:
@@ -460,161 +699,134 @@ def random_create_rule(urbanscape):
 
 #adds new FastFoodAgent in location with highest potential profit to cost ratio
 def profit_probability_create_rule(urbanscape):
-	size = urbanscape.size
-	potential_fflocations = []
-	potential_gslocations = []
-	
-	#makes a list of available coordinates in UrbanScape
-	#only one FastFoodAgent and one GroceryStoreAgent can occupy a block at any given time
-	for i in range(size):
-		for j in range(size):
-		        ff_locs = [loc for agent,loc in urbanscape.agent_coords.items() if 'FastFoodAgent' in str(agent)]
-		        gs_locs = [loc for agent,loc in urbanscape.agent_coords.items() if 'GroceryStoreAgent' in str(agent)]
-			if (i,j) not in ff_locs:
-				potential_fflocations.append((i,j))
-			if (i,j) not in gs_locs:
-			        potential_gslocations.append((i,j))
-	
-	#makes a list of profit:cost ratios at potential_location coordinates
-	potential_fflist = potential_profits(urbanscape, potential_fflocations, agent = 'FF')
-	potential_gslist = potential_profits(urbanscape, potential_gslocations, agent = 'GS')
+	potential_locations = []
+	potential_lists = []
+	for agent_type in agent_types:
+		if urbanscape.vectorized:
+			locations, profits = potential_profit_surface(urbanscape, agent = agent_type.label)
+		else:
+			#makes a list of available coordinates in UrbanScape
+			#only one agent of each type can occupy a block at any given time
+			occupied = zip(*np.nonzero(urbanscape.type_occupancy(agent_type.code)))
+			locations = [(i,j) for i in range(urbanscape.size) for j in range(urbanscape.size) if (i,j) not in occupied]
+
+			#makes a list of profit:cost ratios at potential_location coordinates
+			profits = potential_profits(urbanscape, locations, agent = agent_type.label)
+		potential_locations.append(locations)
+		potential_lists.append(profits)
 	
-	if not potential_fflist and not potential_gslist:
+	if not any(len(profits) for profits in potential_lists):
 		print 'no suitable locations at time ' + str(urbanscape.time)
 		
-	if potential_fflist:
-	       potential_creations(urbanscape, potential_fflocations, potential_fflist,agent='FF')
-	   
-	if potential_gslist:
-	       potential_creations(urbanscape, potential_gslocations, potential_gslist,agent='GS')
+	for agent_type, locations, profits in zip(agent_types, potential_locations, potential_lists):
+		if len(profits):
+			potential_creations(urbanscape, locations, profits, agent = agent_type.label)
 
 #a function that creates agents 
 def potential_creations(urbanscape, potential_locations, potential_list,agent = ''):
-        #generates a random float to make the 'create agent' decision
-       	prob_max = 0.15
-        rand = random.random()
-        maximum = max(potential_list)
-	create_locations = []
+	#generates a random float to make the 'create agent' decision
+	prob_max = urbanscape.parameters.prob_max
+	rand = urbanscape.decisions.random()
+	potential_list = np.asarray(potential_list, dtype=float)
+	maximum = potential_list.max()
 	
 	#generates a 'create' probability based on profit:cost ratios in potential_list
 	#modifies prob_max value by a multiplier based on profit ranges
-	for i in range(len(potential_list)):
-		prob_multiplier = float(potential_list[i])/float(maximum)
-		if prob_multiplier < 0:
-			prob_multiplier = 0
-		probability = prob_max * prob_multiplier
-			
-		#adds the location to create_locations if the 'create agent' decision
-		#is less that the create probability
-		if rand < probability:
-			create_locations.append(potential_locations[i])
+	prob_multiplier = potential_list / maximum
+	prob_multiplier[prob_multiplier < 0] = 0
+	probability = prob_max * prob_multiplier
+	
+	#keeps the locations where the 'create agent' decision is less that the create probability
+	create_locations = np.flatnonzero(rand < probability)
 		
 	#picks a random location from list of locations that made it through the
 	#random 'create agent' decision.
-	if create_locations:
-		choice = random.randint(0,len(create_locations))
-		create_coord = create_locations[choice]
-		
-		if agent == 'FF':
-		      urbanscape.add_agent(FastFoodAgent(create_coord, urbanscape))
-		      
-		if agent == 'GS':
-		      urbanscape.add_agent(GroceryStoreAgent(create_coord, urbanscape))
+	if len(create_locations):
+		choice = urbanscape.decisions.randint(0,len(create_locations))
+		x,y = potential_locations[create_locations[choice]]
+		create_coord = (int(x),int(y))
+		
+		agent_type = agent_type_for(agent)
+		urbanscape.add_agent(agent_type(create_coord, urbanscape))
+
+#the profit margin of a new agent on every block of the urbanscape, as a size x size array.
+#revenue is the box filter of each block's share of expenditures with the new agent added (the +1),
+#and the margin combines the startup and long-run terms used by potential_profits
+def profit_margin_surface(urbanscape, agent = ''):
+	u = urbanscape
+	agent_class = agent_type_for(agent)
+	operations = u.parameters.agent(agent_class, 'operations')
+	spend = getattr(u, agent_class.spend_field)
+	capture_number = getattr(u, agent_class.capture_field)
+	share = (spend / (capture_number+1)) * u.population_per_block
+
+	revenue = kernels.lane_window_sum(share, u.parameters.agent(agent_class, 'radius', ndim=1))
+	startup = u.rent + operations*2
+	profits_short = revenue - startup
+	profits_long = (revenue - operations) * 5
+	return (profits_short/startup) + (profits_long / (operations*5))
+
+#the blocks not yet occupied by an agent of the given type (in row-major order) and their profit margins
+def potential_profit_surface(urbanscape, agent = ''):
+	agent_class = agent_type_for(agent)
+	available = urbanscape.type_occupancy(agent_class.code) == 0
+	margins = profit_margin_surface(urbanscape, agent)
+	return np.argwhere(available), margins[available]
 
 def potential_profits(urbanscape, potential_locations, agent = ''):
-	urbanscape = urbanscape
-	locations = potential_locations
+	agent_type = agent_type_for(agent)
+	operations = urbanscape.parameters.agent(agent_type, 'operations')
+	radius = urbanscape.parameters.agent(agent_type, 'radius')
 	location_profit_list = []
-	for loc in locations:
-	        if agent == 'FF':
-	               startup = (urbanscape.rent[loc]) + (FastFoodAgent.operations)*2
-	               potential_radius = urbanscape.effect_radius(loc,FastFoodAgent.radius)
-	               revenue = potential_revenue(urbanscape,potential_radius,agent)
-	               profits_short = revenue - startup
-	               profits_long = (revenue - FastFoodAgent.operations) * 5
-	               profit_margin = (profits_short/startup) + (profits_long / (FastFoodAgent.operations*5))
-	               location_profit_list.append(profit_margin)
-	       
-	        if agent == 'GS':
-	               startup = (urbanscape.rent[loc]) + (GroceryStoreAgent.operations)*2
-	               potential_radius = urbanscape.effect_radius(loc,GroceryStoreAgent.radius)
-	               revenue = potential_revenue(urbanscape,potential_radius,agent)
-	               profits_short = revenue - startup
-	               profits_long = (revenue - GroceryStoreAgent.operations) * 5
-	               profit_margin = (profits_short/startup) + (profits_long / (GroceryStoreAgent.operations*5))
-	               location_profit_list.append(profit_margin)
+	for loc in potential_locations:
+		startup = (urbanscape.rent[loc]) + (operations)*2
+		potential_radius = urbanscape.effect_radius(loc,radius)
+		revenue = potential_revenue(urbanscape,potential_radius,agent)
+		profits_short = revenue - startup
+		profits_long = (revenue - operations) * 5
+		profit_margin = (profits_short/startup) + (profits_long / (operations*5))
+		location_profit_list.append(profit_margin)
 	               
 	return location_profit_list
 			
 #define create rule variables
 def potential_revenue(urbanscape, coords, agent = ''):
-		coords = coords
-		s = urbanscape.size
-		ff = urbanscape.fast_food
-		gs = urbanscape.grocery
-		ff_cn = urbanscape.ffcapture_number
-		gs_cn = urbanscape.gscapture_number
-		capture_total = 0
-		
-		if agent == 'FF':
-		      for k in range(len(coords)):
-		          x,y = coords[k]
-		          if 0 <= x <= (s-1) and 0 <= y <= (s-1):
-		              cc = (ff[x,y] / (ff_cn[x,y]+1)) * urbanscape.population_per_block
-		              capture_total += cc
-		
-		if agent == 'GS':
-		      for k in range(len(coords)):
-		          x,y = coords[k]
-		          if 0 <= x <= (s-1) and 0 <= y <= (s-1):
-		              cc = (gs[x,y] / (gs_cn[x,y]+1)) * urbanscape.population_per_block
-		              capture_total += cc
-		                      
-		return capture_total
+	agent_type = agent_type_for(agent)
+	s = urbanscape.size
+	spend = getattr(urbanscape, agent_type.spend_field)
+	capture_number = getattr(urbanscape, agent_type.capture_field)
+	capture_total = 0
+	
+	for k in range(len(coords)):
+		x,y = coords[k]
+		if 0 <= x <= (s-1) and 0 <= y <= (s-1):
+			cc = (spend[x,y] / (capture_number[x,y]+1)) * urbanscape.population_per_block
+			capture_total += cc
+	                      
+	return capture_total
 
 #---------------------------------------
 # Functions for Visualizing UrbanScape |
 #---------------------------------------
 
-def plot_urbanscape(urbanscape):
-	fig = pyplot.figure()
-	
-	pyplot.clf()
-	pyplot.subplot(221)
-	ii = urbanscape.income
-	pyplot.imshow(ii, interpolation='nearest')
-	pyplot.title("Income Distribution")
-	pyplot.subplot(221).axes.get_xaxis().set_ticks([])
-	pyplot.subplot(221).axes.get_yaxis().set_ticks([])
-
-	pyplot.subplot(222)
-	ff = urbanscape.ffcapture_number
-	pyplot.imshow(ff, cmap = 'YlOrRd', interpolation='nearest')
-	pyplot.title("FFR Effect Radii")
-	pyplot.subplot(222).axes.get_xaxis().set_ticks([])
-	pyplot.subplot(222).axes.get_yaxis().set_ticks([])
-
-	pyplot.subplot(223)
-	mm = urbanscape.externalities
-	pyplot.imshow(mm, cmap = 'Purples', interpolation='nearest')
-	pyplot.title("Negative Externalities")
-	pyplot.subplot(223).axes.get_xaxis().set_ticks([])
-	pyplot.subplot(223).axes.get_yaxis().set_ticks([])
-	
-	pyplot.subplot(224)
-	ll = urbanscape.agent_locations
-	pyplot.imshow(ll, cmap = 'RdYlGn', interpolation='nearest',vmin=-1,vmax=1)
-	pyplot.title("Food Agent Locations")
-	pyplot.subplot(224).axes.get_xaxis().set_ticks([])
-	pyplot.subplot(224).axes.get_yaxis().set_ticks([])
-	
-	#return fig
+#plotting lives in the plotting module, which imports matplotlib on first use only
+def plot_urbanscape(urbanscape, resolution = lod.default_resolution):
+	import plotting
+	return plotting.plot_urbanscape(urbanscape, resolution)
+
+def plot_experiment(externality_quintiles, urbanscape, resolution = lod.default_resolution):
+	import plotting
+	return plotting.plot_experiment(externality_quintiles, urbanscape, resolution)
+
+def plot_batch_experiments(averages, level = 0.95):
+	import plotting
+	return plotting.plot_batch_experiments(averages, level)
 
 #------------------------------------------------------------------------------
 # Running Simulations that Returns Externalities Exposures by Income Quintile |
 #------------------------------------------------------------------------------
 
-def run_experiment(grid_size, rent_ceiling, create_rule, distribution, randomize = True, steps = 100):
+def run_experiment(grid_size, rent_ceiling, create_rule, distribution, randomize = True, steps = 100, seed = None, parameters = None):
 	
 	n = grid_size
 	ceiling = rent_ceiling
@@ -623,161 +835,168 @@ def run_experiment(grid_size, rent_ceiling, create_rule, distribution, randomize
 	
 	#defining the urbanscape
 	#u = UrbanScape(20,10000,profit_probability_create_rule,'random')
-	u = UrbanScape(n, ceiling, create_rule, distribution, randomize)
+	u = UrbanScape(n, ceiling, create_rule, distribution, randomize, seed = seed, parameters = parameters)
 	
-	externality_quintiles = np.array(([],[],[],[],[]))
+	#mean externality exposure of each income quintile at every step (see kernels.quintile_means)
+	externality_quintiles = np.empty((5,steps))
 	
-	for i in range(steps):
-		u.step()
-		income_distribution = set()
-		for uu in u.income:
-			for ii in uu:
-				income_distribution.add(ii)
-		
-		idist_sorted = sorted(income_distribution)
-		num = len(idist_sorted)
-		quintile_cutoffs = sorted([int((float(num)/float(5))*i - 1) for i in range(1,6)])
-		
-		incomes_q1 = [idist_sorted[i] for i in range(0,quintile_cutoffs[0])]
-		incomes_q2 = [idist_sorted[i] for i in range(quintile_cutoffs[0],quintile_cutoffs[1])]
-		incomes_q3 = [idist_sorted[i] for i in range(quintile_cutoffs[1],quintile_cutoffs[2])]
-		incomes_q4 = [idist_sorted[i] for i in range(quintile_cutoffs[2],quintile_cutoffs[3])]
-		incomes_q5 = [idist_sorted[i] for i in range(quintile_cutoffs[3],quintile_cutoffs[4])]
-		
-		externalities_q1 = []
-		externalities_q2 = []
-		externalities_q3 = []
-		externalities_q4 = []
-		externalities_q5 = []
-		
-		for i in range(n):
-			for j in range(n):
-				
-				if u.income[i,j] in incomes_q1:
-					externalities_q1.append(u.externalities[i,j])
-				elif u.income[i,j] in incomes_q2:
-					externalities_q2.append(u.externalities[i,j])
-				elif u.income[i,j] in incomes_q3:
-					externalities_q3.append(u.externalities[i,j])
-				elif u.income[i,j] in incomes_q4:
-					externalities_q4.append(u.externalities[i,j])
-				elif u.income[i,j] in incomes_q5:
-					externalities_q5.append(u.externalities[i,j])
-					
-		avg_ext_q1 = sum(externalities_q1)/len(externalities_q1)
-		avg_ext_q2 = sum(externalities_q2)/len(externalities_q2)
-		avg_ext_q3 = sum(externalities_q3)/len(externalities_q3)
-		avg_ext_q4 = sum(externalities_q4)/len(externalities_q4)
-		avg_ext_q5 = sum(externalities_q5)/len(externalities_q5)
-		
-		externality_quintiles = np.append(externality_quintiles, [[avg_ext_q1],[avg_ext_q2],[avg_ext_q3],[avg_ext_q4],[avg_ext_q5]],axis=1)
+	records = metrics.observe(u, steps, [('quintiles', metrics.quintile_exposure)])
+	for i, record in enumerate(records):
+		externality_quintiles[:,i] = record['quintiles']
 	
 	terminal_mobility_dist = np.ones_like(u.mobility) * u.mobility
 	terminal_income_dist = np.ones_like(u.income) * u.income
 			
-	return externality_quintiles, terminal_mobility_dist, terminal_income_dist, u.agent_coords
-
-def run_batch_experiments(batches, grid_size, rent_ceiling, create_rule, distribution, randomize=True, steps = 100):
-	batches = batches
-	total_externalities = np.zeros((5,steps))
-	total_terminal_mobility = np.zeros((grid_size,grid_size))
-	total_terminal_income = np.zeros((grid_size,grid_size))
-	total_ffagent_locations = np.zeros((grid_size,grid_size))
-	total_gsagent_locations = np.zeros((grid_size,grid_size))
-	
-	for i in range(batches):
-		experiment = run_experiment(grid_size, rent_ceiling, create_rule, distribution, randomize, steps)
-		total_externalities += experiment[0]
-		total_terminal_mobility += experiment[1]
-		total_terminal_income += experiment[2]
-		agent_coords = experiment[3]
-		
-		ffagent_locations = np.zeros((grid_size,grid_size))
-		gsagent_locations = np.zeros((grid_size,grid_size))
-		
-		for agent, loc in agent_coords.items():
-		        string = str(agent)
-		        x,y = loc
-		            
-		        if 'FastFoodAgent' in string:
-		            ffagent_locations[x,y] = 1
-		                
-		        if 'GroceryStoreAgent' in string:
-		            gsagent_locations[x,y] = 1
-		
-		total_ffagent_locations += ffagent_locations
-		total_gsagent_locations += gsagent_locations
-		
-	avg_externalities = total_externalities/batches
-	avg_terminal_mobility = total_terminal_mobility/batches
-	avg_terminal_income = total_terminal_income/batches
-	avg_ffagent_locations = total_ffagent_locations/batches
-	avg_gsagent_locations = total_gsagent_locations/batches
-	
-	ax1 = pyplot.subplot(321)
-	pyplot.plot(avg_externalities[0], color = 'm', label = 'low-income',linewidth=2.0)
-	pyplot.plot(avg_externalities[1], color = 'r', label = 'low-middle income',linewidth=2.0)
-	pyplot.plot(avg_externalities[2], color = 'y', label = 'middle income',linewidth=2.0)
-	pyplot.plot(avg_externalities[3], color = 'g', label = 'middle-high income',linewidth=2.0)
-	pyplot.plot(avg_externalities[4], color = 'b', label = 'high income',linewidth=2.0)
-	pyplot.legend(bbox_to_anchor=(1.05, 1), loc=2, prop={'size':7}, borderaxespad=0.)
-
-	pyplot.xlabel('time',fontsize=10,fontname='serif')
-	pyplot.ylabel('total exposure',fontsize=10,fontname='serif')
-	pyplot.title('Accumulation of Negative Externalities',fontsize=10,fontname='serif')
-	
-	ax2 = pyplot.subplot(323)
-	pyplot.imshow(avg_terminal_income, interpolation='nearest')
-	pyplot.title('Terminal Income Distribution',fontsize=10,fontname='serif')
-	
-	ax3 = pyplot.subplot(324)
-	pyplot.imshow(avg_terminal_mobility, cmap = 'Purples', interpolation='nearest')
-	pyplot.title('Terminal Mobility Distribution',fontsize=10,fontname='serif')
-	
-	ax4 = pyplot.subplot(325)
-	pyplot.imshow(avg_ffagent_locations, cmap = 'Reds', interpolation='nearest')
-	pyplot.title('Fast Food Agent Locations',fontsize=10,fontname='serif')
-	
-	ax5 = pyplot.subplot(326)
-	pyplot.imshow(avg_gsagent_locations, cmap = 'Greens', interpolation='nearest')
-	pyplot.title('Grocery Store Agent Locations',fontsize=10,fontname='serif')
-	
-	ax1.tick_params(axis='x',labelsize=9)
-        ax1.tick_params(axis='y',labelsize=9)
-	ax2.tick_params(axis='x',labelsize=9)
-        ax2.tick_params(axis='y',labelsize=9)
-        ax3.tick_params(axis='x',labelsize=9)
-        ax3.tick_params(axis='y',labelsize=9)
-        ax4.tick_params(axis='x',labelsize=9)
-        ax4.tick_params(axis='y',labelsize=9)
-        ax5.tick_params(axis='x',labelsize=9)
-        ax5.tick_params(axis='y',labelsize=9)
-	
-	pyplot.show()
-	
-def plot_experiment(externality_quintiles, urbanscape):
-	pyplot.subplot(221)
-	pyplot.plot(externality_quintiles[0], color = 'm', label = 'low-income',linewidth=2.0)
-	pyplot.plot(externality_quintiles[1], color = 'r', label = 'low-middle income',linewidth=2.0)
-	pyplot.plot(externality_quintiles[2], color = 'y', label = 'middle income',linewidth=2.0)
-	pyplot.plot(externality_quintiles[3], color = 'g', label = 'middle-high income',linewidth=2.0)
-	pyplot.plot(externality_quintiles[4], color = 'b', label = 'high income',linewidth=2.0)
-	pyplot.legend(bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0.)
-
-	pyplot.xlabel('time')
-	pyplot.ylabel('total exposure')
-	pyplot.title('Accumulation of Negative Externalities')
-	
-	pyplot.subplot(223)
-	pyplot.imshow(urbanscape.income, interpolation='nearest')
-	pyplot.title('Income Distribution')
-	
-	pyplot.subplot(224)
-	pyplot.imshow(urbanscape.agent_locations, cmap = 'YlOrRd', interpolation='nearest')
-	pyplot.title('Fast Food Locations')
-	pyplot.show()
-	
-	
+	return externality_quintiles, terminal_mobility_dist, terminal_income_dist, u.agents.copy()
+
+#streams an experiment: yields one record per step holding the time and the metrics of the
+#observers due at that step, e.g.
+#	for record in iter_experiment(20, 100000, profit_probability_create_rule, 'CBD',
+#				      observers = [('exposure', metrics.quintile_exposure, 10)]):
+#runs until the consumer stops iterating when steps is None
+def iter_experiment(grid_size, rent_ceiling, create_rule, distribution, randomize = True, steps = None, seed = None, observers = (), parameters = None):
+	u = UrbanScape(grid_size, rent_ceiling, create_rule, distribution, randomize, seed = seed, parameters = parameters)
+	return metrics.observe(u, steps, observers)
+
+#runs one replicate and reduces it to the compact summary that run_batch_experiments averages:
+#externality quintiles, terminal mobility and income, and fast food and grocery store location indicators.
+#takes a single tuple of arguments so it can be mapped over a process pool
+def replicate_summary(arguments):
+	grid_size, rent_ceiling, create_rule, distribution, randomize, steps, seed, parameters = arguments
+	experiment = run_experiment(grid_size, rent_ceiling, create_rule, distribution, randomize, steps, seed, parameters)
+	agents = experiment[3]
+	
+	ffagent_locations = np.zeros((grid_size,grid_size))
+	gsagent_locations = np.zeros((grid_size,grid_size))
+	
+	ffagent_locations[agents.locations(FastFoodAgent.code)] = 1
+	gsagent_locations[agents.locations(GroceryStoreAgent.code)] = 1
+	
+	return experiment[0], experiment[1], experiment[2], ffagent_locations, gsagent_locations
+
+#the summaries of replicates start to start + count, in order. replicate i runs with seed (seed, i);
+#with a pool the replicates run on its worker processes
+def replicate_summaries(start, count, grid_size, rent_ceiling, create_rule, distribution, randomize, steps, seed, parameters = None, pool = None):
+	replicates = [(grid_size, rent_ceiling, create_rule, distribution, randomize, steps, tuple(randomstream.seed_sequence(seed)) + (i,), parameters)
+		      for i in range(start, start + count)]
+	if pool is not None:
+		return pool.imap(replicate_summary, replicates)
+	return itertools.imap(replicate_summary, replicates)
+
+#replicate i runs with seed (seed, i), so a batch with a given seed can be repeated exactly.
+#processes > 1 fans the replicates out to a pool of worker processes; the summaries are
+#reduced in replicate order, so the statistics are the same as for a serial run.
+#ensemble = True instead advances the replicates in lockstep as ensembles of up to
+#memory_budget bytes of state (see ensemble.ensemble_summaries).
+#parameters = the model constants of every replicate (see parameters.ModelParameters).
+#returns an accumulators.BatchStatistics with the per-cell mean, variance, min, max and confidence
+#intervals of every output; only the running statistics are kept, never the replicates' grids
+def run_batch_statistics(batches, grid_size, rent_ceiling, create_rule, distribution, randomize=True, steps = 100, seed = None, processes = 1, ensemble = False, memory_budget = 2**28, parameters = None):
+	statistics = accumulators.BatchStatistics(grid_size, steps)
+	
+	if seed is None:
+		seed = randomstream.fresh_seed()
+	
+	if ensemble:
+		import ensemble as ensembles
+		pool = None
+		summaries = ensembles.ensemble_summaries(batches, grid_size, rent_ceiling, create_rule, distribution, randomize, steps, seed, memory_budget, parameters)
+	else:
+		pool = multiprocessing.Pool(processes) if processes > 1 else None
+		summaries = replicate_summaries(0, batches, grid_size, rent_ceiling, create_rule, distribution, randomize, steps, seed, parameters, pool)
+	
+	try:
+		for summary in summaries:
+			statistics.add(summary)
+	finally:
+		if pool is not None:
+			pool.close()
+			pool.join()
+	
+	return statistics
+
+#run_batch_statistics reduced to the averages of the replicate summaries:
+#(externalities, terminal mobility, terminal income, ffagent locations, gsagent locations).
+#plot them (or the statistics themselves, with confidence bands) with plot_batch_experiments
+def run_batch_experiments(batches, grid_size, rent_ceiling, create_rule, distribution, randomize=True, steps = 100, seed = None, processes = 1, ensemble = False, memory_budget = 2**28, parameters = None):
+	return run_batch_statistics(batches, grid_size, rent_ceiling, create_rule, distribution, randomize, steps, seed,
+				    processes, ensemble, memory_budget, parameters).means()
+
+#-------------------------------------
+# Sequential Stopping                 |
+#-------------------------------------
+
+#a precision target for run_adaptive_statistics: the confidence interval half-width wanted for one
+#output of replicate_summary (see accumulators.summary_names), at the cell index or, with index None,
+#at every cell. as a list, so it can also be given in JSON (e.g. in a sweep)
+def precision_target(output, index, half_width):
+	return [output, None if index is None else list(index), half_width]
+
+#the CI half-width of the final exposure of an income quintile (0 = low income)
+def exposure_target(half_width, quintile = 0, step = -1):
+	return precision_target('externalities', (quintile, step), half_width)
+
+#the widest confidence interval half-width of each target's cells over the target half-width.
+#every target is met when all of them are at most 1
+def target_ratios(statistics, targets, level = 0.95):
+	ratios = []
+	for output, index, half_width in targets:
+		widths = statistics[output].half_width(level)
+		if index is not None:
+			widths = widths[tuple(index)]
+		ratios.append(float(np.max(widths)) / half_width)
+	return ratios
+
+#runs replicates until the confidence intervals of every target are narrow enough or a budget is hit:
+#max_batches replicates or, if given, max_seconds of wall time (checked between rounds).
+#the first round runs min_batches replicates; as a half-width shrinks with the square root of the
+#replicate count, each further round runs about as many more as the widest target still needs,
+#at most doubling the count. round sizes don't depend on processes, so neither does the result.
+#without ensemble, the first n replicates are those of run_batch_statistics(n, ...) with the same seed;
+#ensemble rounds are seeded with (seed, round number), so they don't repeat its ensemble chunks
+#returns (statistics, whether every target was met)
+def run_adaptive_statistics(targets, grid_size, rent_ceiling, create_rule, distribution, randomize=True, steps = 100, seed = None, level = 0.95, min_batches = 8, max_batches = 200, max_seconds = None, processes = 1, ensemble = False, memory_budget = 2**28, parameters = None):
+	statistics = accumulators.BatchStatistics(grid_size, steps)
+	if seed is None:
+		seed = randomstream.fresh_seed()
+	if ensemble:
+		import ensemble as ensembles
+	pool = multiprocessing.Pool(processes) if processes > 1 and not ensemble else None
+	started = time.time()
+	batch = min_batches
+	rounds = 0
+	
+	try:
+		while True:
+			batch = min(batch, max_batches - statistics.count)
+			if ensemble:
+				#each round is an ensemble run of its own, seeded with (seed, round number)
+				round_seed = tuple(randomstream.seed_sequence(seed)) + (rounds,)
+				summaries = ensembles.ensemble_summaries(batch, grid_size, rent_ceiling, create_rule, distribution, randomize, steps, round_seed, memory_budget, parameters)
+			else:
+				summaries = replicate_summaries(statistics.count, batch, grid_size, rent_ceiling, create_rule, distribution, randomize, steps, seed, parameters, pool)
+			for summary in summaries:
+				statistics.add(summary)
+			rounds += 1
+			
+			ratio = max(target_ratios(statistics, targets, level))
+			converged = ratio <= 1
+			if converged or statistics.count >= max_batches:
+				break
+			if max_seconds is not None and time.time() - started >= max_seconds:
+				break
+			if math.isinf(ratio) or math.isnan(ratio):
+				batch = statistics.count
+			else:
+				needed = int(math.ceil(statistics.count * ratio**2)) - statistics.count
+				batch = min(max(needed, 1), statistics.count)
+	finally:
+		if pool is not None:
+			pool.close()
+			pool.join()
+	
+	return statistics, converged
+
 #EXPERIMENTS TO RUN ON SHELL	
 
 #u = UrbanScape(5, 100000,no_create_rule,'vertical', randomize = False)
@@ -790,10 +1009,10 @@ def plot_experiment(externality_quintiles, urbanscape):
 #run_experiment(20,250000,profit_probability_create_rule,'BDquadrants',steps=10)
 #run_experiment(20,250000,profit_probability_create_rule,'CBD',steps=100)
 
-#run_batch_experiments(3,20,200000,random_create_rule,'random',steps=50)
-#run_batch_experiments(3,20,200000,profit_probability_create_rule,'random',steps=50)
-#run_batch_experiments(3,20,200000,profit_probability_create_rule,'CBD',steps=200)
+#plot_batch_experiments(run_batch_experiments(3,20,200000,random_create_rule,'random',steps=50))
+#plot_batch_experiments(run_batch_experiments(3,20,200000,profit_probability_create_rule,'random',steps=50))
+#plot_batch_experiments(run_batch_experiments(3,20,200000,profit_probability_create_rule,'CBD',steps=200))
 
-#run_batch_experiments(50,20,250000,profit_probability_create_rule,'random',steps=200)
-#run_batch_experiments(50,20,250000,profit_probability_create_rule,'vertical',steps=200)
-#run_batch_experiments(50,20,250000,profit_probability_create_rule,'CBD',steps=200)
+#plot_batch_experiments(run_batch_experiments(50,20,250000,profit_probability_create_rule,'random',steps=200))
+#plot_batch_experiments(run_batch_experiments(50,20,250000,profit_probability_create_rule,'vertical',steps=200))
+#plot_batch_experiments(run_batch_experiments(50,20,250000,profit_probability_create_rule,'CBD',steps=200))